@@ -0,0 +1,164 @@
+"""
+Batch analysis of position files on a process pool.
+
+Positions are read from pickle files ([board, castling, turn] as saved by
+the game, .p) and FEN files (one position per row, # for comments), given
+directly or found in directories. Each position is searched in a worker
+process, to a depth and/or within a time budget, and its result is printed
+as a JSON line as soon as it is known (not in the input order):
+    {"source": "set.fen:3", "fen": "...", "best": "e2-e4", "score": 0.3,
+     "depth": 6, "nodes": 81234, "time": 4.21, "pv": "e2-e4 e7-e5 ..."}
+Positions that cannot be read or searched get a line with an "error" instead.
+
+    python3 analyse.py positions/ --depth 6 > results.jsonl
+    python3 analyse.py board.p set.fen --depth 32 --budget-ms 10000 -o out.jsonl
+    python3 analyse.py set.fen --depth 6 --pruning null_move lmr
+    python3 analyse.py set.fen --depth 6 --evaluation batch
+"""
+import argparse
+import json
+import os
+import pickle
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from time import time
+from board import WHITE, BLACK, KING, to_fen, from_fen, upgrade_position
+from transposition import TranspositionTable
+from utils import PRUNING, EVALUATIONS, search, readable_line
+from stats import SearchStats
+
+PICKLE_EXTENSIONS = ('.p', '.pkl', '.pickle')
+FEN_EXTENSIONS = ('.fen', '.epd', '.txt')
+
+# Worker side transposition table, set by _init_worker
+_WORKER_TT = None
+
+def _init_worker(tt_size_mb):
+    global _WORKER_TT
+    _WORKER_TT = TranspositionTable(tt_size_mb)
+
+def _check_position(board):
+    if board.count(WHITE | KING) != 1 or board.count(BLACK | KING) != 1:
+        raise ValueError('one king of each color expected')
+
+def read_files(paths):
+    """
+    Yields (source, FEN or None, error or None) of the positions of the files
+    and directories (files with a known extension, sorted)
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files += sorted(
+                os.path.join(path, name) for name in os.listdir(path)
+                if name.endswith(PICKLE_EXTENSIONS + FEN_EXTENSIONS))
+        else:
+            files.append(path)
+    for path in files:
+        if path.endswith(PICKLE_EXTENSIONS):
+            try:
+                with open(path, 'rb') as _file:
+                    board, castling, turn = upgrade_position(
+                        *pickle.load(_file))
+                _check_position(board)
+                yield path, to_fen(board, castling, turn), None
+            except Exception as error:
+                yield path, None, repr(error)
+            continue
+        with open(path) as _file:
+            for n, row in enumerate(_file, 1):
+                fen = row.split('#')[0].strip()
+                if not fen:
+                    continue
+                source = '{}:{}'.format(path, n)
+                try:
+                    _check_position(from_fen(fen)[0])
+                    yield source, fen, None
+                except Exception as error:
+                    yield source, None, repr(error)
+
+def analyse(source, fen, depth, budget_ms=None, pruning=None,
+            evaluation=None):
+    """
+    Searches a position (in a worker), returns its result line as a dict
+    """
+    board, castling, turn = from_fen(fen)
+    stats = SearchStats()
+    t1 = time()
+    best_move, score, pv = search(turn, board, depth, castling, _WORKER_TT,
+                                  budget_ms=budget_ms, verbose=False,
+                                  stats=stats, pruning=pruning,
+                                  evaluation=evaluation)
+    return {
+        'source': source,
+        'fen': fen,
+        'best': readable_line(pv[:1]) if best_move else None,
+        'score': score,
+        'depth': best_move['depth'] if best_move else 0,
+        'nodes': stats.total_nodes(),
+        'time': round(time() - t1, 2),
+        'pv': readable_line(pv),
+    }
+
+def run(paths, output, depth, budget_ms=None, workers=None, tt_size_mb=64,
+        pruning=None, evaluation=None):
+    """
+    Analyses the positions of paths on workers processes, writes the result
+    lines to output as they come. Returns the number of positions searched
+    pruning: selective search features (see utils.PRUNING), evaluation: leaf
+    scoring (see utils.EVALUATIONS)
+    """
+    searched = 0
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(tt_size_mb,)) as pool:
+        # Future -> source of its position
+        futures = {}
+        for source, fen, error in read_files(paths):
+            if error is None:
+                futures[pool.submit(analyse, source, fen, depth, budget_ms,
+                                    pruning, evaluation)] = source
+            else:
+                output.write(json.dumps({'source': source,
+                                         'error': error}) + '\n')
+                output.flush()
+        for future in as_completed(futures):
+            # A failed search doesn't stop the others
+            try:
+                line = future.result()
+                searched += 1
+            except Exception as error:
+                line = {'source': futures[future], 'error': repr(error)}
+            output.write(json.dumps(line) + '\n')
+            output.flush()
+    return searched
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('paths', nargs='+',
+                        help='pickle or FEN files, or directories of them')
+    parser.add_argument('--depth', type=int, default=5,
+                        help='max depth of the searches')
+    parser.add_argument('--budget-ms', type=int,
+                        help='time budget per position (iterative deepening '
+                             'up to --depth)')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help='processes searching positions in parallel')
+    parser.add_argument('--tt-size-mb', type=int, default=64,
+                        help='transposition table size of each worker')
+    parser.add_argument('--pruning', nargs='*', choices=sorted(PRUNING),
+                        help='selective search features to use (all by '
+                             'default, none if empty)')
+    parser.add_argument('--evaluation', choices=EVALUATIONS,
+                        help='leaf scoring (piece_square by default)')
+    parser.add_argument('-o', '--output', help='JSON Lines file (stdout)')
+    args = parser.parse_args()
+
+    out = sys.stdout if args.output is None else open(args.output, 'w')
+    t_start = time()
+    count = run(args.paths, out, args.depth, args.budget_ms, args.workers,
+                args.tt_size_mb, args.pruning, args.evaluation)
+    if not args.output is None:
+        out.close()
+    print('{} position(s) searched in {:.1f} s'.format(count,
+                                                       time() - t_start),
+          file=sys.stderr)
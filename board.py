@@ -1,74 +1,203 @@
-BOARD = [[{"color": "blank"} for _ in range(8)] for _ in range(8)]
+"""
+Compact board representation.
+
+A board is a flat bytearray of 64 squares, square = 8 * row + col (row 0 is
+black's back rank, as displayed by the web interface). Each square holds a
+small int piece code, color | type, EMPTY (0) being a blank square.
+"""
+from random import Random
+
+EMPTY = 0
+
+PAWN = 1
+KNIGHT = 2
+BISHOP = 3
+ROOK = 4
+QUEEN = 5
+KING = 6
+TYPE_MASK = 7
+
+WHITE = 8
+BLACK = 16
+COLOR_MASK = 24
+
+TYPE_NAMES = {
+    PAWN: 'pawn',
+    KNIGHT: 'knight',
+    BISHOP: 'bishop',
+    ROOK: 'rook',
+    QUEEN: 'queen',
+    KING: 'king',
+}
+COLOR_NAMES = {
+    WHITE: 'white',
+    BLACK: 'black',
+}
+TYPES = {name: typ for typ, name in TYPE_NAMES.items()}
+COLORS = {name: color for color, name in COLOR_NAMES.items()}
+
+BACK_RANK = [ROOK, KNIGHT, BISHOP, QUEEN, KING, BISHOP, KNIGHT, ROOK]
+
+def new_board():
+    """
+    Returns a board set up for a normal start
+    """
+    board = bytearray(64)
+    for c, typ in enumerate(BACK_RANK):
+        board[c] = BLACK | typ
+        board[8 + c] = BLACK | PAWN
+        board[48 + c] = WHITE | PAWN
+        board[56 + c] = WHITE | typ
+    return board
 
 # Normal start board
-BOARD[7] = [
-    {
-        "color": "white",
-        "type": "rook",
-    },
-    {
-        "color": "white",
-        "type": "knight",
-    },
-    {
-        "color": "white",
-        "type": "bishop",
-    },
-    {
-        "color": "white",
-        "type": "queen",
-    },
-    {
-        "color": "white",
-        "type": "king",
-    },
-    {
-        "color": "white",
-        "type": "bishop",
-    },
-    {
-        "color": "white",
-        "type": "knight",
-    },
-    {
-        "color": "white",
-        "type": "rook",
-    },
-]
-BOARD[0] = [
-    {
-        "color": "black",
-        "type": "rook",
-    },
-    {
-        "color": "black",
-        "type": "knight",
-    },
-    {
-        "color": "black",
-        "type": "bishop",
-    },
-    {
-        "color": "black",
-        "type": "queen",
-    },
-    {
-        "color": "black",
-        "type": "king",
-    },
-    {
-        "color": "black",
-        "type": "bishop",
-    },
-    {
-        "color": "black",
-        "type": "knight",
-    },
-    {
-        "color": "black",
-        "type": "rook",
-    },
-]
-
-BOARD[6] = [{"color": "white", "type": "pawn"} for _ in range(8)]
-BOARD[1] = [{"color": "black", "type": "pawn"} for _ in range(8)]
+BOARD = new_board()
+
+def square(row, col):
+    """
+    (row, col) -> square index
+    """
+    return 8 * row + col
+
+def location(sq):
+    """
+    square index -> (row, col)
+    """
+    return sq >> 3, sq & 7
+
+# One shared dict per piece code, used to render a board without allocating
+_PIECE_DICTS = [{'color': 'blank'} for _ in range(COLOR_MASK)]
+for _color, _color_name in COLOR_NAMES.items():
+    for _type, _type_name in TYPE_NAMES.items():
+        _PIECE_DICTS[_color | _type] = {'color': _color_name, 'type': _type_name}
+
+def to_rows(board):
+    """
+    Adapter to the former list-of-dicts layout (board[r][c]['color'],
+    board[r][c]['type']) used by the templates. Returned dicts are shared:
+    do not modify them.
+    """
+    return [[_PIECE_DICTS[board[8 * r + c]] for c in range(8)]
+            for r in range(8)]
+
+def from_rows(rows):
+    """
+    Converts a list-of-dicts board (as saved by former versions) into a compact
+    board
+    """
+    board = bytearray(64)
+    for r, row in enumerate(rows):
+        for c, piece in enumerate(row):
+            if piece['color'] != 'blank':
+                board[8 * r + c] = COLORS[piece['color']] | \
+                    TYPES[piece['type']]
+    return board
+
+def upgrade_position(board, castling, turn):
+    """
+    Takes a (board, castling, turn) triple as pickled by any version and
+    returns it in the compact format
+    """
+    if not isinstance(board, bytearray):
+        board = from_rows(board)
+    castling = {
+        COLORS.get(color, color): dict(rights)
+        for color, rights in castling.items()
+    }
+    return board, castling, COLORS.get(turn, turn)
+
+# Zobrist keys, seeded so that hashes are stable across processes and runs
+_random = Random(2018)
+# Indexed by 64 * piece + square, empty squares hash to 0
+ZOBRIST = [0] * (64 * COLOR_MASK)
+for _color in COLOR_NAMES:
+    for _type in TYPE_NAMES:
+        for _sq in range(64):
+            ZOBRIST[64 * (_color | _type) + _sq] = _random.getrandbits(64)
+ZOBRIST_SIDE = _random.getrandbits(64)
+# (left, right) castling rights keys
+ZOBRIST_CASTLING = {
+    WHITE: (_random.getrandbits(64), _random.getrandbits(64)),
+    BLACK: (_random.getrandbits(64), _random.getrandbits(64)),
+}
+
+def position_hash(board, turn, castling):
+    """
+    Zobrist hash of a position, black to move and castling rights included
+    """
+    key = 0
+    for sq, piece in enumerate(board):
+        key ^= ZOBRIST[64 * piece + sq]
+    if turn == BLACK:
+        key ^= ZOBRIST_SIDE
+    for color, (left_key, right_key) in ZOBRIST_CASTLING.items():
+        if castling[color]['left']:
+            key ^= left_key
+        if castling[color]['right']:
+            key ^= right_key
+    return key
+
+FEN_INITIALS = {
+    PAWN: 'p',
+    KNIGHT: 'n',
+    BISHOP: 'b',
+    ROOK: 'r',
+    QUEEN: 'q',
+    KING: 'k',
+}
+START_FEN = 'rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1'
+
+def from_fen(fen):
+    """
+    Parses a FEN string, returns (board, castling, turn)
+    En-passant and move counters are ignored
+    """
+    fields = fen.split()
+    types = {initial: typ for typ, initial in FEN_INITIALS.items()}
+    board = bytearray(64)
+    for r, row in enumerate(fields[0].split('/')):
+        c = 0
+        for char in row:
+            if char.isdigit():
+                c += int(char)
+            else:
+                color = WHITE if char.isupper() else BLACK
+                board[8 * r + c] = color | types[char.lower()]
+                c += 1
+    turn = WHITE
+    if len(fields) > 1 and fields[1] == 'b':
+        turn = BLACK
+    rights = fields[2] if len(fields) > 2 else '-'
+    castling = {
+        WHITE: {'left': 'Q' in rights, 'right': 'K' in rights},
+        BLACK: {'left': 'q' in rights, 'right': 'k' in rights},
+    }
+    return board, castling, turn
+
+def to_fen(board, castling, turn):
+    """
+    Inverse of from_fen
+    """
+    rows = []
+    for r in range(8):
+        row, blanks = '', 0
+        for piece in board[8 * r:8 * r + 8]:
+            if piece == EMPTY:
+                blanks += 1
+                continue
+            if blanks:
+                row += str(blanks)
+                blanks = 0
+            initial = FEN_INITIALS[piece & TYPE_MASK]
+            row += initial.upper() if piece & WHITE else initial
+        if blanks:
+            row += str(blanks)
+        rows.append(row)
+    rights = ''
+    for color, initials in [(WHITE, 'KQ'), (BLACK, 'kq')]:
+        if castling[color]['right']:
+            rights += initials[0]
+        if castling[color]['left']:
+            rights += initials[1]
+    return '{} {} {} - 0 1'.format('/'.join(rows), 'w' if turn == WHITE else 'b',
+                                   rights or '-')
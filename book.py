@@ -0,0 +1,214 @@
+"""
+Opening book: moves played without searching, by position.
+
+A book file is a header followed by fixed-width records sorted by position
+hash, one record per known move of a position (heaviest first):
+    key     8 bytes  position_hash of the position
+    move    2 bytes  packed move (see transposition.pack_move)
+    weight  2 bytes  how often the move is played, relatively to the others
+The file is memory-mapped and binary searched: it is never loaded in memory,
+and its pages are shared by all the processes reading it.
+
+    python3 book.py build book.bin --lines openings.txt
+    python3 book.py build book.bin --lines openings.txt --plies 8 --depth 4
+    python3 book.py show book.bin --fen "<fen>"
+"""
+import argparse
+import mmap
+import struct
+from random import choices
+from board import position_hash, from_fen, START_FEN
+from game import GameState
+from transposition import TranspositionTable, NO_MOVE, pack_move, unpack_move
+from utils import (
+    available_movements,
+    search,
+    parse_line,
+    readable_line,
+)
+
+MAGIC = b'CGBOOK01'
+# Magic, number of records
+HEADER = struct.Struct('>8sI')
+# Key, move, weight
+RECORD = struct.Struct('>QHH')
+MAX_WEIGHT = 0xffff
+
+class OpeningBook:
+    """
+    Read-only access to a book file
+    """
+
+    def __init__(self, path):
+        with open(path, 'rb') as _file:
+            # The mapping stays valid once the file is closed
+            self._map = mmap.mmap(_file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.size = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC:
+            self._map.close()
+            raise ValueError('{} is not an opening book'.format(path))
+
+    def _record(self, n):
+        return RECORD.unpack_from(self._map, HEADER.size + n * RECORD.size)
+
+    def moves(self, key):
+        """
+        Returns the [(packed move, weight)] known for the position hash key
+        """
+        # First record with this key
+        low, high = 0, self.size
+        while low < high:
+            middle = (low + high) >> 1
+            if self._record(middle)[0] < key:
+                low = middle + 1
+            else:
+                high = middle
+        to_return = []
+        while low < self.size:
+            record_key, move, weight = self._record(low)
+            if record_key != key:
+                break
+            to_return.append((move, weight))
+            low += 1
+        return to_return
+
+    def choose(self, key):
+        """
+        Picks a move of the position at random according to their weights,
+        NO_MOVE if the position is not in the book
+        """
+        moves = self.moves(key)
+        if not moves:
+            return NO_MOVE
+        return choices([move for move, _ in moves],
+                       [weight for _, weight in moves])[0]
+
+    def close(self):
+        self._map.close()
+
+def book_move(book, game):
+    """
+    Book move (start, arrival) of a GameState, None if out of book. Moves
+    that are not legal in the game (hash collision) are ignored
+    """
+    move = book.choose(position_hash(game.board, game.turn, game.castling))
+    if move == NO_MOVE:
+        return None
+    start, arrival = unpack_move(move)
+    if not game.board[start] & game.turn or \
+        not arrival in available_movements(start, game.board,
+                                           game.castling[game.turn]['left'],
+                                           game.castling[game.turn]['right'],
+                                           kpos=game.kpos):
+        return None
+    return start, arrival
+
+def write_book(path, entries):
+    """
+    Writes a book file from {position hash: {packed move: weight}}
+    """
+    records = []
+    for key, moves in entries.items():
+        for move, weight in moves.items():
+            records.append((key, -min(weight, MAX_WEIGHT), move))
+    records.sort()
+    with open(path, 'wb') as _file:
+        _file.write(HEADER.pack(MAGIC, len(records)))
+        for key, weight, move in records:
+            _file.write(RECORD.pack(key, move, -weight))
+    return len(records)
+
+def _new_game(fen):
+    board, castling, turn = from_fen(fen)
+    return GameState(board, turn, castling)
+
+def _add(entries, game, move):
+    moves = entries.setdefault(
+        position_hash(game.board, game.turn, game.castling), {})
+    moves[move] = moves.get(move, 0) + 1
+
+def add_lines(entries, lines, fen=START_FEN):
+    """
+    Adds the moves of lines (lists of packed moves played from fen): a move
+    weighs the number of lines playing it. Raises ValueError on illegal moves
+    """
+    for line in lines:
+        game = _new_game(fen)
+        for n, move in enumerate(line):
+            start, arrival = unpack_move(move)
+            if not game.board[start] & game.turn or \
+                not arrival in available_movements(
+                    start, game.board, game.castling[game.turn]['left'],
+                    game.castling[game.turn]['right'], kpos=game.kpos):
+                raise ValueError('Illegal move {} in {}'.format(
+                    n + 1, readable_line(line)))
+            _add(entries, game, move)
+            game.play(start, arrival)
+
+def add_searches(entries, lines, plies, depth, fen=START_FEN, tt_size_mb=16):
+    """
+    Adds the engine move of the positions of the first plies of lines (and of
+    the starting position), following the engine moves up to plies too
+    """
+    tt = TranspositionTable(tt_size_mb)
+    todo = [[]] + [line[:n] for line in lines
+                   for n in range(1, min(len(line) + 1, plies))]
+    seen = set()
+    while todo:
+        prefix = todo.pop()
+        game = _new_game(fen)
+        for move in prefix:
+            game.play(*unpack_move(move))
+        key = position_hash(game.board, game.turn, game.castling)
+        if key in seen:
+            continue
+        seen.add(key)
+        best_move, score, pv = search(game.turn, game.board, depth,
+                                      game.castling, tt, verbose=False)
+        if best_move is None:
+            continue
+        move = pack_move(best_move['from'], best_move['to'])
+        print('{} -> {} ({})'.format(readable_line(prefix) or 'start',
+                                     readable_line(pv), score))
+        _add(entries, game, move)
+        if len(prefix) + 1 < plies:
+            todo.append(prefix + [move])
+
+def read_lines(path):
+    """
+    Lines file: one line per row ("e2-e4 e7-e5 ..."), # for comments
+    """
+    with open(path) as _file:
+        return [parse_line(row.split('#')[0]) for row in _file
+                if row.split('#')[0].strip()]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    build_parser = subparsers.add_parser('build', help='write a book file')
+    build_parser.add_argument('path')
+    build_parser.add_argument('--lines', help='lines file')
+    build_parser.add_argument('--plies', type=int, default=0,
+                              help='add engine moves in the first plies')
+    build_parser.add_argument('--depth', type=int, default=4,
+                              help='depth of the engine searches')
+    show_parser = subparsers.add_parser('show', help='moves of a position')
+    show_parser.add_argument('path')
+    show_parser.add_argument('--fen', default=START_FEN)
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        book_lines = read_lines(args.lines) if args.lines else []
+        book_entries = {}
+        add_lines(book_entries, book_lines)
+        if args.plies:
+            add_searches(book_entries, book_lines, args.plies, args.depth)
+        print('{} positions, {} moves'.format(
+            len(book_entries), write_book(args.path, book_entries)))
+    else:
+        book = OpeningBook(args.path)
+        fen_board, fen_castling, fen_turn = from_fen(args.fen)
+        for packed, weight in book.moves(position_hash(fen_board, fen_turn,
+                                                       fen_castling)):
+            print('{} {}'.format(readable_line([packed]), weight))
+        book.close()
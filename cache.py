@@ -0,0 +1,178 @@
+"""
+Search results kept on disk between runs.
+
+Results (best move, score, searched depth) are stored in an SQLite file keyed
+by the position FEN, which holds the pieces, the castling rights and the side
+to move. The most recently used ones are also kept in memory. The least
+recently used results are evicted past max_entries.
+
+    python3 cache.py warm results.db --fens positions.txt --depth 5
+    python3 cache.py warm results.db --pickles board.p 2_turn_checkmate.p
+    python3 cache.py stats results.db
+"""
+import argparse
+import pickle
+import sqlite3
+from collections import OrderedDict
+from threading import Lock
+from time import time
+from board import to_fen, from_fen, upgrade_position
+from transposition import TranspositionTable, pack_move
+from utils import search, readable_line
+
+class ResultCache:
+    """
+    Persistent {position: (packed move, score, depth)} store with an LRU front
+    Scores are from the side to move's point of view
+    """
+
+    def __init__(self, path, max_entries=100000, memory_entries=1024):
+        self.max_entries = max_entries
+        self.memory_entries = memory_entries
+        self._memory = OrderedDict()
+        # Flask may serve requests from several threads
+        self._lock = Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('CREATE TABLE IF NOT EXISTS results ('
+                         'fen TEXT PRIMARY KEY, move INTEGER, score REAL, '
+                         'depth INTEGER, used REAL)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS results_used '
+                         'ON results (used)')
+        self._db.commit()
+        # memory hits, disk hits, misses
+        self.stats = [0, 0, 0]
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute('SELECT COUNT(*) FROM results')\
+                .fetchone()[0]
+
+    def _remember(self, fen, result):
+        self._memory[fen] = result
+        self._memory.move_to_end(fen)
+        if len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    def get(self, board, castling, turn, depth=0):
+        """
+        Returns (packed move, score, depth) if the position was searched at
+        least to depth (or is a mate), else None
+        """
+        fen = to_fen(board, castling, turn)
+        with self._lock:
+            result = self._memory.get(fen)
+            if result is None:
+                row = self._db.execute(
+                    'SELECT move, score, depth FROM results WHERE fen = ?',
+                    (fen,)).fetchone()
+                if row is None:
+                    self.stats[2] += 1
+                    return None
+                result = tuple(row)
+                self._db.execute('UPDATE results SET used = ? WHERE fen = ?',
+                                 (time(), fen))
+                self._db.commit()
+                self.stats[1] += 1
+            else:
+                self.stats[0] += 1
+            self._remember(fen, result)
+        if result[2] < depth and abs(result[1]) <= 900:
+            return None
+        return result
+
+    def put(self, board, castling, turn, move, score, depth):
+        """
+        Stores a result, unless the position is known from a deeper search
+        """
+        fen = to_fen(board, castling, turn)
+        with self._lock:
+            self._db.execute(
+                'INSERT INTO results VALUES (?, ?, ?, ?, ?) '
+                'ON CONFLICT (fen) DO UPDATE SET move = excluded.move, '
+                'score = excluded.score, depth = excluded.depth, '
+                'used = excluded.used WHERE excluded.depth >= results.depth',
+                (fen, move, score, depth, time()))
+            row = self._db.execute(
+                'SELECT move, score, depth FROM results WHERE fen = ?',
+                (fen,)).fetchone()
+            self._remember(fen, tuple(row))
+            self._evict()
+            self._db.commit()
+
+    def _evict(self):
+        excess = self._db.execute('SELECT COUNT(*) FROM results')\
+            .fetchone()[0] - self.max_entries
+        if excess > 0:
+            for (fen,) in self._db.execute(
+                    'SELECT fen FROM results ORDER BY used LIMIT ?',
+                    (excess,)).fetchall():
+                self._memory.pop(fen, None)
+            self._db.execute(
+                'DELETE FROM results WHERE fen IN '
+                '(SELECT fen FROM results ORDER BY used LIMIT ?)', (excess,))
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+def warm(cache, positions, depth, budget_ms=None, tt_size_mb=64):
+    """
+    Searches the (board, castling, turn) positions not yet in cache at depth,
+    stores the results. Returns the number of searches run
+    """
+    tt = TranspositionTable(tt_size_mb)
+    searched = 0
+    for board, castling, turn in positions:
+        if not cache.get(board, castling, turn, depth) is None:
+            continue
+        best_move, score, pv = search(turn, board, depth, castling, tt,
+                                      budget_ms=budget_ms, verbose=False)
+        searched += 1
+        if best_move is None:
+            continue
+        cache.put(board, castling, turn,
+                  pack_move(best_move['from'], best_move['to']), score,
+                  best_move['depth'])
+        print('{} -> {} ({})'.format(to_fen(board, castling, turn),
+                                     readable_line(pv), score))
+    return searched
+
+def read_positions(fens_path=None, pickle_paths=()):
+    """
+    Positions from a FEN file (one per row) and from pickled boards
+    """
+    positions = []
+    if not fens_path is None:
+        with open(fens_path) as _file:
+            positions += [from_fen(row) for row in _file if row.strip()]
+    for path in pickle_paths:
+        with open(path, 'rb') as _file:
+            board, castling, turn = upgrade_position(*pickle.load(_file))
+        positions.append((board, castling, turn))
+    return positions
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    warm_parser = subparsers.add_parser('warm', help='search positions')
+    warm_parser.add_argument('path')
+    warm_parser.add_argument('--fens', help='FEN file, one per row')
+    warm_parser.add_argument('--pickles', nargs='*', default=[],
+                             help='pickled [board, castling, turn] files')
+    warm_parser.add_argument('--depth', type=int, default=5)
+    warm_parser.add_argument('--budget-ms', type=int,
+                             help='time budget per position')
+    warm_parser.add_argument('--max-entries', type=int, default=100000)
+    stats_parser = subparsers.add_parser('stats', help='cache size')
+    stats_parser.add_argument('path')
+    args = parser.parse_args()
+
+    if args.command == 'warm':
+        result_cache = ResultCache(args.path, max_entries=args.max_entries)
+        print('{} position(s) searched'.format(warm(
+            result_cache, read_positions(args.fens, args.pickles),
+            args.depth, args.budget_ms)))
+    else:
+        result_cache = ResultCache(args.path)
+        print('{} position(s)'.format(len(result_cache)))
+    result_cache.close()
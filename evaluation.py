@@ -0,0 +1,364 @@
+"""
+Positional evaluation: material, piece-square tables and mobility.
+
+Scores are white's point of view, in pawns (tables in centipawns). Piece-square
+tables are tapered: middle game and endgame values are weighted by the game
+phase, computed from the pieces left. score_leaf evaluates a board in Python,
+score_batch evaluates many boards at once with NumPy (the boards as rows of a
+small integer array), giving the same scores. Without NumPy, score_batch
+falls back to score_leaf. The search keeps the piece-square part of its
+scores up to date move by move instead (see piece_square_tables).
+
+    python3 evaluation.py --bench                # per leaf vs batched
+    python3 evaluation.py --fen "<fen>"
+"""
+import argparse
+from random import Random
+from time import perf_counter
+from board import (
+    PAWN,
+    KNIGHT,
+    BISHOP,
+    ROOK,
+    QUEEN,
+    KING,
+    WHITE,
+    BLACK,
+    COLOR_MASK,
+    TYPE_MASK,
+    START_FEN,
+    from_fen,
+)
+from tables import RAYS, KNIGHT_TARGETS, DIRECTION_SLIDERS
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# utils.PIECE_VALUES, in centipawns
+MATERIAL_VALUES = [0, 100, 300, 300, 500, 900, 0]
+
+# White's tables, as seen from white's side (rank 8 first, square 0 is a8).
+# Black pieces read them mirrored (sq ^ 56)
+MIDDLE_GAME_TABLES = {
+    PAWN: [
+        0, 0, 0, 0, 0, 0, 0, 0,
+        50, 50, 50, 50, 50, 50, 50, 50,
+        10, 10, 20, 30, 30, 20, 10, 10,
+        5, 5, 10, 25, 25, 10, 5, 5,
+        0, 0, 0, 20, 20, 0, 0, 0,
+        5, -5, -10, 0, 0, -10, -5, 5,
+        5, 10, 10, -20, -20, 10, 10, 5,
+        0, 0, 0, 0, 0, 0, 0, 0,
+    ],
+    KNIGHT: [
+        -50, -40, -30, -30, -30, -30, -40, -50,
+        -40, -20, 0, 0, 0, 0, -20, -40,
+        -30, 0, 10, 15, 15, 10, 0, -30,
+        -30, 5, 15, 20, 20, 15, 5, -30,
+        -30, 0, 15, 20, 20, 15, 0, -30,
+        -30, 5, 10, 15, 15, 10, 5, -30,
+        -40, -20, 0, 5, 5, 0, -20, -40,
+        -50, -40, -30, -30, -30, -30, -40, -50,
+    ],
+    BISHOP: [
+        -20, -10, -10, -10, -10, -10, -10, -20,
+        -10, 0, 0, 0, 0, 0, 0, -10,
+        -10, 0, 5, 10, 10, 5, 0, -10,
+        -10, 5, 5, 10, 10, 5, 5, -10,
+        -10, 0, 10, 10, 10, 10, 0, -10,
+        -10, 10, 10, 10, 10, 10, 10, -10,
+        -10, 5, 0, 0, 0, 0, 5, -10,
+        -20, -10, -10, -10, -10, -10, -10, -20,
+    ],
+    ROOK: [
+        0, 0, 0, 0, 0, 0, 0, 0,
+        5, 10, 10, 10, 10, 10, 10, 5,
+        -5, 0, 0, 0, 0, 0, 0, -5,
+        -5, 0, 0, 0, 0, 0, 0, -5,
+        -5, 0, 0, 0, 0, 0, 0, -5,
+        -5, 0, 0, 0, 0, 0, 0, -5,
+        -5, 0, 0, 0, 0, 0, 0, -5,
+        0, 0, 0, 5, 5, 0, 0, 0,
+    ],
+    QUEEN: [
+        -20, -10, -10, -5, -5, -10, -10, -20,
+        -10, 0, 0, 0, 0, 0, 0, -10,
+        -10, 0, 5, 5, 5, 5, 0, -10,
+        -5, 0, 5, 5, 5, 5, 0, -5,
+        0, 0, 5, 5, 5, 5, 0, -5,
+        -10, 5, 5, 5, 5, 5, 0, -10,
+        -10, 0, 5, 0, 0, 0, 0, -10,
+        -20, -10, -10, -5, -5, -10, -10, -20,
+    ],
+    KING: [
+        -30, -40, -40, -50, -50, -40, -40, -30,
+        -30, -40, -40, -50, -50, -40, -40, -30,
+        -30, -40, -40, -50, -50, -40, -40, -30,
+        -30, -40, -40, -50, -50, -40, -40, -30,
+        -20, -30, -30, -40, -40, -30, -30, -20,
+        -10, -20, -20, -20, -20, -20, -20, -10,
+        20, 20, 0, 0, 0, 0, 20, 20,
+        20, 30, 10, 0, 0, 10, 30, 20,
+    ],
+}
+
+# Endgame tables, where they differ from the middle game ones: pawns
+# close to promotion, active king
+ENDGAME_TABLES = dict(MIDDLE_GAME_TABLES)
+ENDGAME_TABLES[PAWN] = [
+    0, 0, 0, 0, 0, 0, 0, 0,
+    80, 80, 80, 80, 80, 80, 80, 80,
+    50, 50, 50, 50, 50, 50, 50, 50,
+    30, 30, 30, 30, 30, 30, 30, 30,
+    20, 20, 20, 20, 20, 20, 20, 20,
+    10, 10, 10, 10, 10, 10, 10, 10,
+    0, 0, 0, 0, 0, 0, 0, 0,
+    0, 0, 0, 0, 0, 0, 0, 0,
+]
+ENDGAME_TABLES[KING] = [
+    -50, -40, -30, -20, -20, -30, -40, -50,
+    -30, -20, -10, 0, 0, -10, -20, -30,
+    -30, -10, 20, 30, 30, 20, -10, -30,
+    -30, -10, 30, 40, 40, 30, -10, -30,
+    -30, -10, 30, 40, 40, 30, -10, -30,
+    -30, -10, 20, 30, 30, 20, -10, -30,
+    -30, -30, 0, 0, 0, 0, -30, -30,
+    -50, -30, -30, -30, -30, -30, -30, -50,
+]
+
+# Game phase: MAX_PHASE with all pieces (pawns and kings apart) on the board,
+# 0 without any
+PHASE_WEIGHTS = {KNIGHT: 1, BISHOP: 1, ROOK: 2, QUEEN: 4}
+MAX_PHASE = 24
+# Hash key of each phase, seeded like the Zobrist keys: the search mixes its
+# root's one into the transposition table keys, its scores depending on it
+_random = Random(MAX_PHASE)
+PHASE_KEYS = [_random.getrandbits(64) for _ in range(MAX_PHASE + 1)]
+
+# Centipawns per square a piece attacks (empty or enemy): pawns and kings
+# have none
+MOBILITY_WEIGHTS = {KNIGHT: 4, BISHOP: 4, ROOK: 2, QUEEN: 1}
+
+def _signed(color):
+    return 1 if color == WHITE else -1
+
+# Indexed by piece (color | type), signed (white's point of view)
+MATERIAL = [0] * 32
+PHASE = [0] * 32
+# PIECE_SQUARE[phase][piece][sq]: tapered tables, rounded to centipawns
+PIECE_SQUARE = [[[0] * 64 for _ in range(32)] for _ in range(MAX_PHASE + 1)]
+MOBILITY = [0] * 32
+# Directions (see tables.DIRECTIONS) each piece slides along
+SLIDES = [()] * 32
+for _color in (WHITE, BLACK):
+    for _typ, _table in MIDDLE_GAME_TABLES.items():
+        _piece = _color | _typ
+        MATERIAL[_piece] = _signed(_color) * MATERIAL_VALUES[_typ]
+        PHASE[_piece] = PHASE_WEIGHTS.get(_typ, 0)
+        _end_table = ENDGAME_TABLES[_typ]
+        for _phase in range(MAX_PHASE + 1):
+            PIECE_SQUARE[_phase][_piece] = [
+                _signed(_color) * round(
+                    (_table[_sq] * _phase +
+                     _end_table[_sq] * (MAX_PHASE - _phase)) / MAX_PHASE)
+                for _sq in (range(64) if _color == WHITE else
+                            [sq ^ 56 for sq in range(64)])]
+        MOBILITY[_piece] = _signed(_color) * MOBILITY_WEIGHTS.get(_typ, 0)
+        SLIDES[_piece] = tuple(
+            d for d, slider in enumerate(DIRECTION_SLIDERS)
+            if _typ in (slider, QUEEN))
+
+def game_phase(board):
+    """
+    From MAX_PHASE (opening) to 0 (pawns and kings only)
+    """
+    return min(MAX_PHASE, sum(PHASE[piece] for piece in board))
+
+def piece_square_tables(board):
+    """
+    Tapered tables of the board's game phase, in pawns: [piece][sq], white's
+    point of view. The search scores moves with them (the phase of the
+    searched position being kept for the whole tree)
+    """
+    return [[value / 100 for value in table]
+            for table in PIECE_SQUARE[game_phase(board)]]
+
+def score_leaf(board, material=True, piece_square=True, mobility=True):
+    """
+    Score of a board, made of the material, piece-square and mobility terms
+    asked for
+    """
+    total = 0
+    tables = PIECE_SQUARE[game_phase(board)]
+    for sq, piece in enumerate(board):
+        if not piece:
+            continue
+        if piece_square:
+            total += tables[piece][sq]
+        if material:
+            total += MATERIAL[piece]
+        if not mobility:
+            continue
+        weight = MOBILITY[piece]
+        if not weight:
+            continue
+        own = piece & COLOR_MASK
+        reach = 0
+        if piece & TYPE_MASK == KNIGHT:
+            for target in KNIGHT_TARGETS[sq]:
+                if not board[target] & own:
+                    reach += 1
+        else:
+            rays = RAYS[sq]
+            for d in SLIDES[piece]:
+                for target in rays[d]:
+                    if board[target]:
+                        if not board[target] & own:
+                            reach += 1
+                        break
+                    reach += 1
+        total += weight * reach
+    return total / 100
+
+if not np is None:
+    # Padding square (past the edge of a ray, missing knight target), and
+    # the value it holds: neither empty nor of any color
+    _PAD = 64
+    _EDGE = 0xff
+    _MATERIAL = np.array(MATERIAL, np.int64)
+    _PHASE = np.array(PHASE, np.int64)
+    _PIECE_SQUARE = np.array(PIECE_SQUARE, np.int64)
+    _MOBILITY = np.array(MOBILITY, np.int64)
+    _SQUARES = np.arange(64)
+    # Pieces moving as sliders, as knights
+    _SLIDERS = np.array([bool(slides) for slides in SLIDES])
+    _KNIGHTS = np.zeros(32, bool)
+    _KNIGHTS[[WHITE | KNIGHT, BLACK | KNIGHT]] = True
+    # _SLIDES[piece, d]: 1 if the piece slides along direction d
+    _SLIDES = np.zeros((32, 8), np.int64)
+    for _piece, _directions in enumerate(SLIDES):
+        _SLIDES[_piece, list(_directions)] = 1
+    # _RAY_SQUARES[sq, d, k]: k-th square of RAYS[sq][d], padded
+    _RAY_SQUARES = np.full((64, 8, 8), _PAD, np.intp)
+    _KNIGHT_SQUARES = np.full((64, 8), _PAD, np.intp)
+    for _sq in range(64):
+        for _d, _ray in enumerate(RAYS[_sq]):
+            _RAY_SQUARES[_sq, _d, :len(_ray)] = _ray
+        _KNIGHT_SQUARES[_sq, :len(KNIGHT_TARGETS[_sq])] = KNIGHT_TARGETS[_sq]
+
+def score_batch(boards, material=True, piece_square=True, mobility=True):
+    """
+    score_leaf of each board (sequence of 64 bytes boards), as a list.
+    Computed in one go with NumPy (if installed)
+    """
+    if np is None:
+        return [score_leaf(board, material, piece_square, mobility)
+                for board in boards]
+    if not boards:
+        return []
+    # One row per board, plus the padding square
+    rows = np.full((len(boards), 65), _EDGE, np.uint8)
+    rows[:, :64] = np.frombuffer(b''.join(boards), np.uint8).reshape(-1, 64)
+    squares = rows[:, :64]
+    total = np.zeros(len(boards), np.int64)
+    if piece_square:
+        phases = np.minimum(_PHASE[squares].sum(1), MAX_PHASE)
+        total += _PIECE_SQUARE[phases[:, None], squares, _SQUARES].sum(1)
+    if material:
+        total += _MATERIAL[squares].sum(1)
+    if not mobility:
+        return (total / 100).tolist()
+
+    # Sliders: empty squares before the first piece of each ray (rays end
+    # with a padding square), plus that piece if it is an enemy
+    board_index, sq = np.nonzero(_SLIDERS[squares])
+    if len(sq):
+        pieces = squares[board_index, sq]
+        rays = rows[board_index[:, None, None], _RAY_SQUARES[sq]]
+        reach = (rays != 0).argmax(2)
+        first = np.take_along_axis(rays, reach[..., None], axis=2)[..., 0]
+        reach += (first != _EDGE) & (
+            first & COLOR_MASK != (pieces & COLOR_MASK)[:, None])
+        total += np.bincount(
+            board_index, _MOBILITY[pieces] * (reach * _SLIDES[pieces]).sum(1),
+            len(boards)).astype(np.int64)
+
+    # Knights: targets not holding an own piece
+    board_index, sq = np.nonzero(_KNIGHTS[squares])
+    if len(sq):
+        pieces = squares[board_index, sq]
+        targets = rows[board_index[:, None], _KNIGHT_SQUARES[sq]]
+        reach = ((targets != _EDGE) & (
+            targets & COLOR_MASK != (pieces & COLOR_MASK)[:, None])).sum(1)
+        total += np.bincount(board_index, _MOBILITY[pieces] * reach,
+                             len(boards)).astype(np.int64)
+    return (total / 100).tolist()
+
+# Middle game positions to take sibling leaves from
+BENCH_POSITIONS = [
+    START_FEN,
+    'r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1',
+    'r4rk1/1pp1qppp/p1np1n2/2b1p1B1/2B1P1b1/P1NP1N2/1PP1QPPP/R4RK1 w - - 0 10',
+    'r1bq1rk1/pp2bppp/2n1pn2/3p4/2PP4/2N1PN2/PP3PPP/R2QKB1R w KQ - 0 8',
+    '2r2rk1/pp1bqppp/2n1pn2/3p4/3P4/2PBPN2/P1Q2PPP/R4RK1 b - - 0 14',
+]
+
+def benchmark(repeat=200):
+    """
+    Prints the time per leaf of score_leaf and score_batch on the children of
+    BENCH_POSITIONS (siblings batched together, as in the search), and on
+    batches of a fixed size
+    """
+    from utils import all_available_movements, play, unplay, king_position
+
+    siblings = []
+    for fen in BENCH_POSITIONS:
+        board, _, turn = from_fen(fen)
+        kpos = {turn: king_position(turn, board)}
+        leaves = []
+        for move in all_available_movements(turn, board, 0, kpos, False,
+                                            False):
+            unplay_infos = play(move['from'], move['to'], board)
+            leaves.append(bytes(board))
+            unplay(*unplay_infos, board=board)
+        siblings.append(leaves)
+    leaves = [leaf for batch in siblings for leaf in batch]
+    assert [score_leaf(leaf) for leaf in leaves] == \
+        [score for batch in siblings for score in score_batch(batch)]
+
+    def per_leaf_time(batches):
+        t_start = perf_counter()
+        for _ in range(repeat):
+            for batch in batches:
+                score_batch(batch)
+        count = sum(len(batch) for batch in batches)
+        return 1e6 * (perf_counter() - t_start) / (repeat * count)
+
+    t_start = perf_counter()
+    for _ in range(repeat):
+        for leaf in leaves:
+            score_leaf(leaf)
+    python = 1e6 * (perf_counter() - t_start) / (repeat * len(leaves))
+    print('NumPy: {}'.format('no' if np is None else np.__version__))
+    print('Per leaf:         {:6.1f} us/leaf'.format(python))
+    print('Siblings ({:.0f} avg): {:6.1f} us/leaf'.format(
+        len(leaves) / len(siblings), per_leaf_time(siblings)))
+    for size in (1, 8, 16, 32, 64, 128):
+        batches = [leaves[n:n + size] for n in range(0, len(leaves), size)]
+        print('Batches of {:3}:   {:6.1f} us/leaf'.format(
+            size, per_leaf_time(batches)))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--fen', help='position to evaluate')
+    parser.add_argument('--bench', action='store_true',
+                        help='compare per leaf and batched evaluation')
+    parser.add_argument('--repeat', type=int, default=200,
+                        help='benchmark rounds')
+    args = parser.parse_args()
+    if args.bench:
+        benchmark(args.repeat)
+    else:
+        print(score_leaf(from_fen(args.fen or START_FEN)[0]))
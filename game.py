@@ -0,0 +1,141 @@
+"""
+State of a game in progress.
+"""
+from board import (
+    WHITE,
+    BLACK,
+    COLOR_MASK,
+    TYPE_MASK,
+    PAWN,
+    KNIGHT,
+    BISHOP,
+    ROOK,
+    QUEEN,
+    TYPE_NAMES,
+    new_board,
+)
+from utils import (
+    PIECE_VALUES,
+    play,
+    unplay,
+    play_castling,
+    unplay_castling,
+    king_position,
+    enemy,
+)
+
+# Pieces of each type in a full set, indexed by piece type
+FULL_SET = [0, 8, 2, 2, 2, 1, 1]
+
+class GameState:
+    """
+    Board, side to move and castling rights of a game, with the material
+    balance, the pieces count and the captured pieces updated by play() and
+    unplay() instead of being computed from the board.
+    """
+
+    def __init__(self, board=None, turn=WHITE, castling=None):
+        if board is None:
+            board = new_board()
+        if castling is None:
+            castling = {
+                WHITE: {'left': True, 'right': True},
+                BLACK: {'left': True, 'right': True},
+            }
+        self.board = board
+        self.turn = turn
+        self.castling = castling
+        self.kpos = {
+            WHITE: king_position(WHITE, board),
+            BLACK: king_position(BLACK, board),
+        }
+        # Indexed by piece type
+        self.counts = {WHITE: [0] * 7, BLACK: [0] * 7}
+        # White's point of view
+        self.material = 0
+        for piece in board:
+            if piece:
+                self.counts[piece & COLOR_MASK][piece & TYPE_MASK] += 1
+                if piece & WHITE:
+                    self.material += PIECE_VALUES[piece & TYPE_MASK]
+                else:
+                    self.material -= PIECE_VALUES[piece & TYPE_MASK]
+        # Taken pieces of each color, indexed by piece type. Unknown history:
+        # everything missing from a full set was taken
+        self.captured = {
+            color: [max(0, full - count)
+                    for full, count in zip(FULL_SET, self.counts[color])]
+            for color in (WHITE, BLACK)
+        }
+        self.history = []
+
+    def play(self, start, arrival):
+        """
+        Plays start -> arrival for the side to move (move assumed legal)
+        """
+        color = self.turn
+        unplay_infos = play(start, arrival, self.board, self.kpos)
+        _, former_start, _, former_arrival = unplay_infos
+        former_castling, _ = play_castling(self.castling, color, start,
+                                           arrival)
+        sign = 1 if color == WHITE else -1
+        if former_arrival:
+            taken = former_arrival & TYPE_MASK
+            self.counts[color ^ COLOR_MASK][taken] -= 1
+            self.captured[color ^ COLOR_MASK][taken] += 1
+            self.material += sign * PIECE_VALUES[taken]
+        # Promotion
+        promoted = self.board[arrival] & TYPE_MASK
+        if promoted != former_start & TYPE_MASK:
+            self.counts[color][PAWN] -= 1
+            self.counts[color][promoted] += 1
+            self.material += sign * (PIECE_VALUES[promoted] -
+                                     PIECE_VALUES[PAWN])
+        self.history.append((unplay_infos, former_castling))
+        self.turn = enemy(color)
+
+    def unplay(self):
+        """
+        Undo the last play()
+        """
+        unplay_infos, former_castling = self.history.pop()
+        _, former_start, arrival, former_arrival = unplay_infos
+        color = former_start & COLOR_MASK
+        sign = 1 if color == WHITE else -1
+        promoted = self.board[arrival] & TYPE_MASK
+        if promoted != former_start & TYPE_MASK:
+            self.counts[color][PAWN] += 1
+            self.counts[color][promoted] -= 1
+            self.material -= sign * (PIECE_VALUES[promoted] -
+                                     PIECE_VALUES[PAWN])
+        if former_arrival:
+            taken = former_arrival & TYPE_MASK
+            self.counts[color ^ COLOR_MASK][taken] += 1
+            self.captured[color ^ COLOR_MASK][taken] -= 1
+            self.material -= sign * PIECE_VALUES[taken]
+        unplay(*unplay_infos, board=self.board, kpos=self.kpos)
+        unplay_castling(self.castling, color, former_castling)
+        self.turn = color
+
+    def score(self, color):
+        """
+        Material balance (+ in favour of the color)
+        """
+        if color == WHITE:
+            return self.material
+        return -self.material
+
+    def missing(self):
+        """
+        Taken pieces names, as expected by the template
+        """
+        to_return = {
+            "black": [],
+            "white": [],
+        }
+        for _color, _name in [(WHITE, 'white'), (BLACK, 'black')]:
+            for _type in [QUEEN, ROOK, BISHOP, KNIGHT, PAWN]:
+                to_return[_name] += [TYPE_NAMES[_type]] * \
+                    self.captured[_color][_type]
+        to_return['black'].reverse()
+        return to_return
@@ -0,0 +1,250 @@
+"""
+Games in progress, by game id.
+
+Each game has its own lock, held while it is played on (requests and
+background searches). Games are saved as they are played, as a move log (see
+movelog.py). Games left idle are dropped from memory, then replayed from
+their log the next time they are asked for; logs not used for long are
+deleted.
+"""
+import os
+import secrets
+from collections import OrderedDict
+from threading import Lock, RLock
+from time import time
+from board import position_hash
+from game import GameState
+from movelog import create_log, load_log, remove_log
+from utils import is_check2, legal_move_map
+
+# Delay between two looks for idle and expired games
+SWEEP_SECONDS = 60
+
+def position_info(state):
+    """
+    Legal moves ({departure: [arrivals]}, see utils.legal_move_map), check
+    and status ('playing', 'mate' or 'draw') of a GameState's position
+    """
+    moves = legal_move_map(state.turn, state.board, state.kpos,
+                           state.castling[state.turn]['left'],
+                           state.castling[state.turn]['right'])
+    check = is_check2(state.turn, state.board)
+    status = 'playing'
+    if not any(moves.values()):
+        status = 'mate' if check else 'draw'
+    return {'moves': moves, 'check': check, 'status': status}
+
+class PositionCache:
+    """
+    LRU {position hash: position_info} shared by the games: the moves and
+    status of a position are computed once, however often its page is asked
+    for. Returned infos are shared: do not modify them
+    """
+
+    def __init__(self, max_entries=4096):
+        self.max_entries = max_entries
+        self._infos = OrderedDict()
+        self._lock = Lock()
+        # hits, misses
+        self.stats = [0, 0]
+
+    def __len__(self):
+        return len(self._infos)
+
+    def get(self, state, key=None):
+        """
+        position_info of the GameState, key being its position_hash if known
+        """
+        if key is None:
+            key = position_hash(state.board, state.turn, state.castling)
+        with self._lock:
+            info = self._infos.get(key)
+            if not info is None:
+                self._infos.move_to_end(key)
+                self.stats[0] += 1
+                return info
+            self.stats[1] += 1
+        info = position_info(state)
+        with self._lock:
+            self._infos[key] = info
+            if len(self._infos) > self.max_entries:
+                self._infos.popitem(last=False)
+        return info
+
+class Game:
+    """
+    A GameState, its MoveLog and the state of its page: highlighted and
+    selected squares, autoplay search. Moves and status come from the
+    PositionCache
+    """
+
+    def __init__(self, game_id, state, log, positions):
+        self.id = game_id
+        self.state = state
+        self.log = log
+        self.positions = positions
+        self.highlighted = []
+        self.selected = []
+        self.autoplay_job = None
+        self.lock = RLock()
+        self.used = time()
+        # position_hash of the position, None once played on
+        self._key = None
+
+    def info(self):
+        """
+        position_info of the position
+        """
+        with self.lock:
+            state = self.state
+            if self._key is None:
+                self._key = position_hash(state.board, state.turn,
+                                          state.castling)
+            return self.positions.get(state, self._key)
+
+    def moves(self):
+        """
+        {departure: [arrivals]} of the side to move
+        """
+        return self.info()['moves']
+
+    def finished(self):
+        return self.info()['status'] != 'playing'
+
+    def play(self, start, arrival):
+        """
+        Plays start -> arrival (move assumed legal) and logs it
+        """
+        with self.lock:
+            self.state.play(start, arrival)
+            self.log.append(self.state, start, arrival)
+            self._key = None
+            self.highlighted = []
+            self.selected = []
+
+    def reload(self):
+        """
+        Replaces the game by its saved version (replayed from its log), clears
+        the page state
+        """
+        with self.lock:
+            self.log.close()
+            self.state, self.log = load_log(self.log.path)
+            self._key = None
+            self.highlighted = []
+            self.selected = []
+
+    def searching(self):
+        return not self.autoplay_job is None and self.autoplay_job.running()
+
+class GameStore:
+    """
+    {game id: Game}, logged in directory. Games idle for idle_seconds are
+    only kept there, and deleted after expiry_seconds
+    """
+
+    def __init__(self, directory, idle_seconds=600,
+                 expiry_seconds=7 * 24 * 3600, positions=None):
+        self.directory = directory
+        self.positions = PositionCache() if positions is None else positions
+        self.idle_seconds = idle_seconds
+        self.expiry_seconds = expiry_seconds
+        os.makedirs(directory, exist_ok=True)
+        self._games = {}
+        self._lock = Lock()
+        self._swept = time()
+
+    def __len__(self):
+        return len(self._games)
+
+    def _path(self, game_id):
+        return os.path.join(self.directory, game_id)
+
+    def create(self, state=None):
+        """
+        New Game (new GameState by default) with a fresh id
+        """
+        self.sweep()
+        with self._lock:
+            game_id = secrets.token_hex(8)
+            while game_id in self._games or \
+                    os.path.exists(self._path(game_id) + '.snap'):
+                game_id = secrets.token_hex(8)
+            if state is None:
+                state = GameState()
+            game = Game(game_id, state, create_log(self._path(game_id), state),
+                        self.positions)
+            self._games[game_id] = game
+        return game
+
+    def get(self, game_id):
+        """
+        Game of the id, replayed from its log if it was idle. None if unknown
+        or expired
+        """
+        self.sweep()
+        # Ids are hexadecimal tokens, never paths
+        if not game_id or game_id.strip('0123456789abcdef'):
+            return None
+        with self._lock:
+            game = self._games.get(game_id)
+            if game is None:
+                path = self._path(game_id)
+                if not os.path.exists(path + '.snap'):
+                    return None
+                game = Game(game_id, *load_log(path), self.positions)
+                self._games[game_id] = game
+            game.used = time()
+        return game
+
+    def delete(self, game_id):
+        with self._lock:
+            game = self._games.pop(game_id, None)
+            if not game is None:
+                if game.searching():
+                    game.autoplay_job.cancel()
+                game.log.close()
+            remove_log(self._path(game_id))
+
+    def sweep(self, force=False):
+        """
+        Syncs the logs, forgets idle games (unless searching), deletes
+        expired logs. Does nothing if done less than SWEEP_SECONDS ago
+        """
+        now = time()
+        with self._lock:
+            if not force and now - self._swept < SWEEP_SECONDS:
+                return
+            self._swept = now
+            for game in list(self._games.values()):
+                # Played on right now: not idle, synced by the next sweep
+                if not game.lock.acquire(blocking=False):
+                    continue
+                try:
+                    if now - game.used > self.idle_seconds and \
+                            not game.searching():
+                        game.log.close()
+                        del self._games[game.id]
+                    else:
+                        game.log.sync(force=True)
+                finally:
+                    game.lock.release()
+            for name in os.listdir(self.directory):
+                if not name.endswith('.snap') or name[:-5] in self._games:
+                    continue
+                path = self._path(name[:-5])
+                used = max(os.path.getmtime(path + suffix)
+                           for suffix in ('.snap', '.log')
+                           if os.path.exists(path + suffix))
+                if now - used > self.expiry_seconds:
+                    remove_log(path)
+
+    def close(self):
+        """
+        Syncs and closes every log, e.g. before the process exits
+        """
+        with self._lock:
+            for game in self._games.values():
+                with game.lock:
+                    game.log.close()
+            self._games = {}
@@ -0,0 +1,119 @@
+"""
+Searches run in the background, their progress being polled.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from itertools import count
+from threading import Event, Lock
+from time import time
+from transposition import NO_MOVE
+from utils import readable_line
+
+# Finished jobs kept for status requests
+KEPT_JOBS = 16
+
+class SearchJob:
+    """
+    A search running on a JobQueue. run(progress, stop) does the search:
+    progress is the dict it keeps up to date, stop the Event it watches (see
+    utils.search)
+    """
+
+    def __init__(self, job_id, run, on_done=None):
+        self.id = job_id
+        self.state = 'queued'
+        self.result = None
+        self.error = None
+        self.progress = {}
+        self.stop = Event()
+        self.started = None
+        self.ended = None
+        self._run = run
+        self._on_done = on_done
+
+    def __call__(self):
+        if self.stop.is_set():
+            self.state = 'cancelled'
+            return
+        self.state = 'running'
+        self.started = time()
+        try:
+            self.result = self._run(self.progress, self.stop)
+            if self.stop.is_set():
+                self.state = 'cancelled'
+            else:
+                if not self._on_done is None:
+                    self._on_done(self.result)
+                self.state = 'done'
+        except Exception as error:
+            self.error = repr(error)
+            self.state = 'failed'
+            raise
+        finally:
+            self.ended = time()
+
+    def running(self):
+        return self.state in ('queued', 'running')
+
+    def cancel(self):
+        """
+        Stops the search, its result won't be used
+        """
+        self.stop.set()
+
+    def status(self):
+        """
+        JSON ready summary of the job
+        """
+        progress = self.progress
+        elapsed = 0
+        if not self.started is None:
+            elapsed = (self.ended or time()) - self.started
+        nodes = progress.get('nodes', 0)
+        root_total = progress.get('root_total', 0)
+        best = progress.get('best', NO_MOVE)
+        return {
+            'id': self.id,
+            'state': self.state,
+            'depth': progress.get('depth', 0),
+            'nodes': nodes,
+            'nps': int(nodes / elapsed) if elapsed else 0,
+            'best': readable_line([best]) if best != NO_MOVE else None,
+            'score': progress.get('score', 0),
+            'percent': int(100 * progress.get('root_done', 0) / root_total)
+                       if root_total else 0,
+            'elapsed': round(elapsed, 2),
+            'error': self.error,
+        }
+
+class JobQueue:
+    """
+    Runs SearchJobs one at a time on a background thread
+    """
+
+    def __init__(self, workers=1):
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._jobs = {}
+        self._ids = count(1)
+        self._lock = Lock()
+
+    def submit(self, run, on_done=None):
+        """
+        Queues run(progress, stop), on_done(result) being called once it
+        succeeds (not cancelled). Returns the SearchJob
+        """
+        with self._lock:
+            job = SearchJob(next(self._ids), run, on_done)
+            self._jobs[job.id] = job
+            # Forget the oldest finished jobs
+            finished = [job_id for job_id, other in self._jobs.items()
+                        if not other.running()]
+            for job_id in finished[:max(0, len(finished) - KEPT_JOBS)]:
+                del self._jobs[job_id]
+        self._executor.submit(job)
+        return job
+
+    def get(self, job_id):
+        """
+        SearchJob of the id, None if unknown
+        """
+        return self._jobs.get(job_id)
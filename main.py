@@ -1,154 +1,298 @@
-import pickle
-from board import BOARD
-from flask import Flask, render_template, redirect
+import os
+from collections import deque
+from board import (
+    WHITE,
+    COLOR_NAMES,
+    square,
+    location,
+    to_rows,
+    to_fen,
+)
+from flask import Flask, render_template, redirect, jsonify, abort, request
 from utils import (
-    available_movements,
-    get_score,
-    build_tree,
-    play,
-    is_check_mate_or_draw,
+    search,
     enemy,
-    update_castling,
-    missing_pieces,
 )
+from games import GameStore
+from book import OpeningBook, book_move
+from cache import ResultCache
+from transposition import TranspositionTable, pack_move, unpack_move
+from parallel import search_parallel
+from jobs import JobQueue
+from stats import SearchStats
 
 app = Flask(__name__)
 
-HIGHLIGHTED = []
-SELECTED = []
-TURN = 'white'
-DEPTH = 6
-AUTOSAVE = True
-CASTLING = {
-    'white': {
-        'left': True,
-        'right': True,
-    },
-    'black': {
-        'left': True,
-        'right': True,
-    }
-}
+# Max depth of the search, and time budget of an autoplay (None: fixed depth)
+DEPTH = 4
+TIME_BUDGET_MS = 5000
+# Memory cap of the transposition table kept between searches
+TT_SIZE_MB = 64
+# Processes searching root moves in parallel (1: search in the server process)
+WORKERS = os.cpu_count() or 1
+
+# Opening book played without searching (see book.py), if the file exists
+BOOK_PATH = 'book.bin'
+# Search results kept between runs (see cache.py). Results of searches less
+# deep than CACHE_MIN_DEPTH are searched again
+CACHE_PATH = 'results.db'
+CACHE_MAX_ENTRIES = 100000
+CACHE_MIN_DEPTH = 4
+# Games in progress (see games.py): idle ones are kept on disk
+GAMES_PATH = 'games'
+GAME_IDLE_SECONDS = 600
+GAME_EXPIRY_SECONDS = 7 * 24 * 3600
+# Statistics of the last searches, served by /stats/searches (see stats.py)
+KEPT_SEARCH_STATS = 50
+# Directory of the pstats files of the searches (None: no profiling). Only
+# searches run in the server process (WORKERS = 1) are profiled
+PROFILE_DIR = None
+
+GAMES = GameStore(GAMES_PATH, GAME_IDLE_SECONDS, GAME_EXPIRY_SECONDS)
 
 """
 with open('1_turn_checkmate_error.p', 'rb') as _file:
-    BOARD, CASTLING, TURN = pickle.load(_file)
+    _board, _castling, _turn = upgrade_position(*pickle.load(_file))
+    GAMES.create(GameState(_board, _turn, _castling))
 """
 
-MISSING = missing_pieces(BOARD)
-SCORE = get_score(TURN, BOARD)
-FINISHED, _ = is_check_mate_or_draw(TURN, BOARD)
+TT = TranspositionTable(TT_SIZE_MB)
+BOOK = OpeningBook(BOOK_PATH) if os.path.exists(BOOK_PATH) else None
+CACHE = ResultCache(CACHE_PATH, CACHE_MAX_ENTRIES)
+# Searches run in the background, one at a time for all games
+JOBS = JobQueue()
+SEARCH_STATS = deque(maxlen=KEPT_SEARCH_STATS)
+
+def get_game(game_id):
+    """
+    Game of the id, 404 if unknown or expired
+    """
+    game = GAMES.get(game_id)
+    if game is None:
+        abort(404)
+    return game
+
+def game_url(game, path=''):
+    return '/game/{}/{}'.format(game.id, path)
 
 @app.route('/')
-def index():
-    message = "{}'s turn".format(TURN.title())
-    is_ended, end_type = is_check_mate_or_draw(TURN, BOARD)
-    if is_ended and end_type == 'mate':
-        message = 'Check Mate ! {} wins.'.format(enemy(TURN).title())
-    if is_ended and end_type == 'draw':
-        message = 'Match ends: draw'
-    return render_template('index.html', board=BOARD, highlight=HIGHLIGHTED,
-                           selected=SELECTED, turn=TURN, score=SCORE,
-                           message=message, missing=MISSING)
-
-@app.route('/moves/<path:subpath>')
-def show_moves(subpath):
-
-    # If game is finished, do nothing
-    if FINISHED:
-        return redirect('/')
-
-    _split = subpath.split('/')
-    assert len(_split) == 2
-    row, col = _split
-    row = int(row)
-    col = int(col)
-    to_highlight = available_movements((row, col), BOARD, CASTLING[TURN]['left'],
-                                       CASTLING[TURN]['right'])
-    # replace HIGHLIGHTED by to_highlight
-    for _ in range(len(HIGHLIGHTED)):
-        del HIGHLIGHTED[0]
-    for elt in to_highlight:
-        HIGHLIGHTED.append(elt)
-    # replace SELECTED by (row, col)
-    for _ in range(len(SELECTED)):
-        del SELECTED[0]
-    SELECTED.append((row, col))
-
-    return redirect('/')
-
-@app.route('/play/<path:subpath>')
-def play_route(subpath):
-
-    # If game is finished, do nothing
-    global FINISHED
-    if FINISHED:
-        return redirect('/')
-
-    _split = subpath.split('/')
-    assert len(_split) == 4
-    srow, scol, arow, acol = _split
-    srow, scol = int(srow), int(scol)
-    arow, acol = int(arow), int(acol)
-
-    # Move the piece
-    play((srow, scol), (arow, acol), BOARD)
-    # empty HIGHLIGHTED
-    for _ in range(len(HIGHLIGHTED)):
-        del HIGHLIGHTED[0]
-    # empty SELECTED
-    for _ in range(len(SELECTED)):
-        del SELECTED[0]
-    # Change score
-    global SCORE
-    SCORE = get_score('white', BOARD)
-
-    # Update CASTLING
-    global TURN
-    CASTLING[TURN]['left'], CASTLING[TURN]['right'] = update_castling(
-        (srow, scol),
-        TURN,
-        CASTLING[TURN]['left'],
-        CASTLING[TURN]['right'],
-    )
-
-    # Change player up next
-    TURN = enemy(TURN)
-
-    # Update MISSING
-    global MISSING
-    MISSING = missing_pieces(BOARD)
-
-    # Autosave in board.p on white's turns
-    if AUTOSAVE and TURN == 'white':
-        with open('board.p', 'wb') as _file:
-            pickle.dump([BOARD, CASTLING, TURN], _file)
-
-    # update FINISHED boolean
-    FINISHED, _ = is_check_mate_or_draw(TURN, BOARD)
-
-    return redirect('/')
-
-@app.route('/load')
-def load_board():
-    global BOARD, CASTLING, TURN, MISSING
-    with open('board.p', 'rb') as _file:
-        BOARD, CASTLING, TURN = pickle.load(_file)
-    MISSING = missing_pieces(BOARD)
-    return redirect('/')
-
-@app.route('/autoplay')
-def autoplay():
-
-    # If game is finished, do nothing
-    if FINISHED:
-        return redirect('/')
-
-    # find the best move
-    tree, best_index = build_tree(TURN, BOARD, DEPTH, CASTLING)
-
-    # Get departure/arrival positions
-    srow, scol = tree[best_index]['from']
-    arow, acol = tree[best_index]['to']
-
-    return redirect('/play/{}/{}/{}/{}'.format(srow, scol, arow, acol))
+def new_game():
+    return redirect(game_url(GAMES.create()))
+
+def game_status(game):
+    """
+    JSON ready state of a game: board (see board.to_rows), side to move,
+    white's score, captured pieces, check, status ('playing', 'mate' or
+    'draw') and legal moves {departure square: [arrival squares]}
+    """
+    with game.lock:
+        state = game.state
+        turn = state.turn
+        info = game.info()
+        message = "{}'s turn".format(COLOR_NAMES[turn].title())
+        if info['status'] == 'mate':
+            message = 'Check Mate ! {} wins.'.format(
+                COLOR_NAMES[enemy(turn)].title())
+        if info['status'] == 'draw':
+            message = 'Match ends: draw'
+        return {
+            'id': game.id,
+            'board': to_rows(state.board),
+            'turn': COLOR_NAMES[turn],
+            'score': state.score(WHITE),
+            'missing': state.missing(),
+            'check': info['check'],
+            'status': info['status'],
+            'message': message,
+            'moves': info['moves'],
+            'searching': game.searching(),
+        }
+
+@app.route('/game/<game_id>/')
+def index(game_id):
+    game = get_game(game_id)
+    with game.lock:
+        status = game_status(game)
+        job = game.autoplay_job.status() if game.searching() else None
+        return render_template('index.html', game_url=game_url(game),
+                               board=status['board'],
+                               highlight=game.highlighted,
+                               selected=game.selected, turn=status['turn'],
+                               score=status['score'],
+                               message=status['message'],
+                               missing=status['missing'], job=job,
+                               state=status)
+
+@app.route('/game/<game_id>/state')
+def state_route(game_id):
+    """
+    game_status as JSON: everything the page needs to show the position and
+    highlight moves without asking the server
+    """
+    return jsonify(game_status(get_game(game_id)))
+
+@app.route('/game/<game_id>/moves/<path:subpath>')
+def show_moves(game_id, subpath):
+    game = get_game(game_id)
+
+    with game.lock:
+        # If game is finished, do nothing
+        if game.finished():
+            return redirect(game_url(game))
+
+        _split = subpath.split('/')
+        assert len(_split) == 2
+        row, col = _split
+        row = int(row)
+        col = int(col)
+        to_highlight = game.moves().get(square(row, col), [])
+        game.highlighted = [location(elt) for elt in to_highlight]
+        game.selected = [(row, col)]
+
+    return redirect(game_url(game))
+
+def cancel_autoplay(game):
+    if not game.autoplay_job is None:
+        game.autoplay_job.cancel()
+
+@app.route('/game/<game_id>/play/<path:subpath>')
+def play_route(game_id, subpath):
+    game = get_game(game_id)
+
+    with game.lock:
+        # If game is finished, do nothing
+        if game.finished():
+            return redirect(game_url(game))
+
+        _split = subpath.split('/')
+        assert len(_split) == 4
+        srow, scol, arow, acol = _split
+        srow, scol = int(srow), int(scol)
+        arow, acol = int(arow), int(acol)
+
+        start, arrival = square(srow, scol), square(arow, acol)
+        if not arrival in game.moves().get(start, []):
+            return redirect(game_url(game))
+
+        # A running autoplay search is about the previous position
+        cancel_autoplay(game)
+        game.play(start, arrival)
+
+    return redirect(game_url(game))
+
+@app.route('/game/<game_id>/load')
+def load_board(game_id):
+    """
+    Restores the game from its move log
+    """
+    game = get_game(game_id)
+    with game.lock:
+        cancel_autoplay(game)
+        game.reload()
+    return redirect(game_url(game))
+
+@app.route('/game/<game_id>/autoplay')
+def autoplay(game_id):
+    game = get_game(game_id)
+
+    with game.lock:
+        # If game is finished or already searching, do nothing
+        if game.finished() or game.searching():
+            return redirect(game_url(game))
+
+        state = game.state
+
+        # In book: no search
+        move = None
+        if not BOOK is None:
+            move = book_move(BOOK, state)
+
+        # Searched before
+        if move is None:
+            cached = CACHE.get(state.board, state.castling, state.turn,
+                               CACHE_MIN_DEPTH)
+            if not cached is None:
+                move = unpack_move(cached[0])
+
+        if not move is None:
+            game.play(*move)
+            return redirect(game_url(game))
+
+        # find the best move in the background, on a copy of the position
+        ply, turn = len(state.history), state.turn
+        board = bytearray(state.board)
+        castling = {color: dict(rights)
+                    for color, rights in state.castling.items()}
+        fen = to_fen(board, castling, turn)
+
+        def run(progress, stop):
+            stats = SearchStats()
+            if WORKERS > 1:
+                result = search_parallel(turn, board, DEPTH, castling,
+                                         WORKERS, budget_ms=TIME_BUDGET_MS,
+                                         tt_size_mb=TT_SIZE_MB // WORKERS,
+                                         progress=progress, stop=stop,
+                                         stats=stats)
+            else:
+                result = search(turn, board, DEPTH, castling, TT,
+                                budget_ms=TIME_BUDGET_MS, progress=progress,
+                                stop=stop, stats=stats,
+                                profile_dir=PROFILE_DIR)
+            searched = stats.as_dict()
+            searched.update(game=game.id, fen=fen, workers=WORKERS,
+                            cancelled=stop.is_set())
+            SEARCH_STATS.append(searched)
+            return result
+
+        def on_done(result):
+            best_move, score, _ = result
+            move = best_move['from'], best_move['to']
+            CACHE.put(board, castling, turn, pack_move(*move), score,
+                      best_move['depth'])
+            with game.lock:
+                # Unless the game went on (or was reloaded) meanwhile
+                if game.state is state and len(state.history) == ply:
+                    game.play(*move)
+
+        game.autoplay_job = JOBS.submit(run, on_done)
+    return redirect(game_url(game))
+
+@app.route('/game/<game_id>/autoplay/status')
+def autoplay_status(game_id):
+    """
+    Progress of the last autoplay search of the game
+    """
+    game = get_game(game_id)
+    if game.autoplay_job is None:
+        return jsonify({'state': 'none'})
+    return jsonify(game.autoplay_job.status())
+
+@app.route('/game/<game_id>/autoplay/cancel')
+def autoplay_cancel(game_id):
+    game = get_game(game_id)
+    cancel_autoplay(game)
+    return redirect(game_url(game))
+
+@app.route('/stats')
+def stats():
+    """
+    Hit and miss counters of the caches
+    """
+    positions = GAMES.positions
+    return jsonify({
+        'games': len(GAMES),
+        'positions': {'hits': positions.stats[0],
+                      'misses': positions.stats[1],
+                      'entries': len(positions)},
+        'results': {'memory_hits': CACHE.stats[0], 'disk_hits': CACHE.stats[1],
+                    'misses': CACHE.stats[2]},
+    })
+
+@app.route('/stats/searches')
+def search_stats():
+    """
+    Statistics of the last searches (?n=, all kept ones by default), most
+    recent first
+    """
+    n = request.args.get('n', KEPT_SEARCH_STATS, type=int)
+    return jsonify(list(SEARCH_STATS)[::-1][:n])
@@ -0,0 +1,154 @@
+"""
+Games saved as an append-only log of their moves.
+
+A saved game is two files:
+    <path>.snap  pickled (plies, GameState) after the first plies moves
+    <path>.log   the moves played since, one record per move:
+        ply   2 bytes  number of moves played before this one
+        move  2 bytes  packed move (see transposition.pack_move)
+Moves are written to the log as they are played, and synced to disk in
+batches: every FSYNC_EVERY moves, or FSYNC_SECONDS after the last sync (on
+the next move, or by the game store sweep). Every SNAPSHOT_EVERY moves the
+snapshot is rewritten and the log emptied. Loading replays the log through
+GameState.play, skipping moves already in the snapshot (crash between the two
+steps of a snapshot) and stopping at a torn record.
+
+    python3 movelog.py show games/<game id>
+"""
+import argparse
+import os
+import pickle
+import struct
+from time import time
+from board import to_fen
+from transposition import pack_move, unpack_move
+from utils import readable_line
+
+# Ply, move
+RECORD = struct.Struct('>HH')
+FSYNC_EVERY = 8
+FSYNC_SECONDS = 1.0
+SNAPSHOT_EVERY = 64
+
+class MoveLog:
+    """
+    Log of a game being played, open for appending. Use create_log or
+    load_log to get one
+    """
+
+    def __init__(self, path, plies, snapshot_plies):
+        self.path = path
+        # Moves played in the game, and in its snapshot
+        self.plies = plies
+        self.snapshot_plies = snapshot_plies
+        self._file = open(path + '.log', 'ab')
+        self._unsynced = 0
+        self._synced = time()
+
+    def append(self, state, start, arrival):
+        """
+        Logs start -> arrival, just played in the GameState
+        """
+        self._file.write(RECORD.pack(self.plies, pack_move(start, arrival)))
+        # In the OS from now on: only a system crash can lose it
+        self._file.flush()
+        self.plies += 1
+        self._unsynced += 1
+        if self.plies - self.snapshot_plies >= SNAPSHOT_EVERY:
+            self.snapshot(state)
+        else:
+            self.sync()
+
+    def sync(self, force=False):
+        """
+        fsyncs the moves written since the last sync, if there are
+        FSYNC_EVERY of them or the last sync is FSYNC_SECONDS old (or force)
+        """
+        if not self._unsynced:
+            return
+        if force or self._unsynced >= FSYNC_EVERY or \
+                time() - self._synced >= FSYNC_SECONDS:
+            os.fsync(self._file.fileno())
+            self._unsynced = 0
+            self._synced = time()
+
+    def snapshot(self, state):
+        """
+        Saves the GameState (played up to now) and empties the log
+        """
+        _write_snapshot(self.path, self.plies, state)
+        self._file.truncate(0)
+        os.fsync(self._file.fileno())
+        self.snapshot_plies = self.plies
+        self._unsynced = 0
+        self._synced = time()
+
+    def close(self):
+        self.sync(force=True)
+        self._file.close()
+
+def _write_snapshot(path, plies, state):
+    # Written aside first: a crash leaves the previous snapshot
+    with open(path + '.snap.tmp', 'wb') as _file:
+        pickle.dump((plies, state), _file)
+        _file.flush()
+        os.fsync(_file.fileno())
+    os.replace(path + '.snap.tmp', path + '.snap')
+
+def create_log(path, state):
+    """
+    Saves a new game from its GameState, returns its MoveLog
+    """
+    _write_snapshot(path, 0, state)
+    with open(path + '.log', 'wb'):
+        pass
+    return MoveLog(path, 0, 0)
+
+def read_game(path):
+    """
+    Returns (GameState, plies in the snapshot, logged packed moves replayed)
+    of a saved game. Raises FileNotFoundError if there is none
+    """
+    with open(path + '.snap', 'rb') as _file:
+        plies, state = pickle.load(_file)
+    moves = []
+    if os.path.exists(path + '.log'):
+        with open(path + '.log', 'rb') as _file:
+            data = _file.read()
+        # A torn last record is ignored
+        for ply, move in RECORD.iter_unpack(
+                data[:len(data) - len(data) % RECORD.size]):
+            if ply < plies + len(moves):
+                continue
+            if ply > plies + len(moves):
+                break
+            state.play(*unpack_move(move))
+            moves.append(move)
+    return state, plies, moves
+
+def load_log(path):
+    """
+    Replays a saved game, returns (GameState, MoveLog). The log is compacted
+    into a new snapshot, dropping records that were not replayed
+    """
+    state, plies, moves = read_game(path)
+    log = MoveLog(path, plies + len(moves), plies)
+    log.snapshot(state)
+    return state, log
+
+def remove_log(path):
+    for suffix in ('.snap', '.log', '.snap.tmp'):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    show_parser = subparsers.add_parser('show', help='position and moves')
+    show_parser.add_argument('path', help='saved game, without suffix')
+    args = parser.parse_args()
+
+    game_state, snapshot_plies, logged = read_game(args.path)
+    print('{} plies in the snapshot, {} logged: {}'.format(
+        snapshot_plies, len(logged), readable_line(logged)))
+    print(to_fen(game_state.board, game_state.castling, game_state.turn))
@@ -0,0 +1,238 @@
+"""
+Root split search on a process pool.
+
+Root moves are searched in separate processes. Each search reads the best
+root score found so far (shared memory alpha) to cut the moves that cannot do
+better. The pool is created once per process and kept between searches.
+"""
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from multiprocessing import Array
+from threading import Lock
+from time import time
+from utils import (
+    MAX_DEPTH,
+    EVALUATION,
+    search,
+    all_available_movements,
+    order_moves,
+    get_score,
+    king_position,
+    readable_line,
+)
+from board import WHITE, BLACK
+from transposition import TranspositionTable, NO_MOVE, pack_move
+from stats import SearchStats
+
+# Number of searches that can share the pool at the same time
+SLOTS = 64
+# Alpha written in a slot to make its running searches stop
+STOP = 5000
+# Seconds between two looks at the stop event of a search
+STOP_POLL = 0.1
+
+_POOL = None
+_POOL_LOCK = Lock()
+_ALPHAS = None
+_NEXT_SLOT = [0]
+
+# Worker side globals, set by _init_worker
+_WORKER_ALPHAS = None
+_WORKER_TT = None
+# Evaluation the scores of _WORKER_TT come from
+_WORKER_EVALUATION = None
+
+def _init_worker(alphas, tt_size_mb):
+    global _WORKER_ALPHAS, _WORKER_TT
+    _WORKER_ALPHAS = alphas
+    _WORKER_TT = TranspositionTable(tt_size_mb)
+
+def get_pool(workers, tt_size_mb=16):
+    """
+    Returns the process pool, created on first call only
+    tt_size_mb is the size of each worker's transposition table
+    """
+    global _POOL, _ALPHAS
+    with _POOL_LOCK:
+        if _POOL is None:
+            _ALPHAS = Array('d', SLOTS)
+            _POOL = ProcessPoolExecutor(max_workers=workers,
+                                        initializer=_init_worker,
+                                        initargs=(_ALPHAS, tt_size_mb))
+    return _POOL
+
+def shutdown_pool():
+    global _POOL
+    with _POOL_LOCK:
+        if not _POOL is None:
+            _POOL.shutdown(cancel_futures=True)
+            _POOL = None
+
+def _search_move(color, board, depth, castling, start, arrival, slot,
+                 pruning=None, evaluation=None):
+    """
+    Worker job: searches a single root move, returns its value, whether it is
+    exact, its line and the SearchStats of the search
+    A value not above the best root value so far is only an upper bound: the
+    search cut on that value (shared alpha)
+    """
+    global _WORKER_EVALUATION
+
+    def alpha_source():
+        return _WORKER_ALPHAS[slot]
+
+    if evaluation is None:
+        evaluation = EVALUATION
+    # Scores of another evaluation would be cut on: start from an empty table
+    if evaluation != _WORKER_EVALUATION:
+        _WORKER_TT.clear()
+        _WORKER_EVALUATION = evaluation
+    stats = SearchStats()
+    best_move, value, pv = search(color, bytearray(board), depth, castling,
+                                  _WORKER_TT, root_moves=[(start, arrival)],
+                                  alpha=alpha_source(),
+                                  alpha_source=alpha_source, verbose=False,
+                                  stats=stats, pruning=pruning,
+                                  evaluation=evaluation)
+    if best_move is None:
+        return None, False, [], stats
+    # The alpha the search cut on is at most the shared one
+    with _WORKER_ALPHAS.get_lock():
+        exact = value > _WORKER_ALPHAS[slot]
+        if exact:
+            _WORKER_ALPHAS[slot] = value
+    return value, exact, pv, stats
+
+def search_parallel(color, board, depth, castling, workers, budget_ms=None,
+                    tt_size_mb=16, progress=None, stop=None, stats=None,
+                    pruning=None, evaluation=None, verbose=True):
+    """
+    Same contract as search (returns best_move, score, pv), the root moves
+    being searched on the process pool. Iterative deepening is used if a
+    budget_ms is given (up to depth, no limit if None), the result of the
+    last completed depth is returned.
+    progress nodes and stats are counted when root moves are done (stats
+    time is the wall time: timers add up the workers' ones)
+    """
+    if progress is None:
+        progress = {}
+    if stats is None:
+        stats = SearchStats()
+    if depth is None:
+        depth = MAX_DEPTH
+    progress.update(depth=0, nodes=0, root_done=0, root_total=0, best=NO_MOVE,
+                    score=0)
+    pool = get_pool(workers, tt_size_mb)
+    with _POOL_LOCK:
+        slot = _NEXT_SLOT[0]
+        _NEXT_SLOT[0] = (slot + 1) % SLOTS
+
+    kpos = {
+        WHITE: king_position(WHITE, board),
+        BLACK: king_position(BLACK, board),
+    }
+    moves = all_available_movements(color, board, get_score(color, board),
+                                    kpos, castling[color]['left'],
+                                    castling[color]['right'])
+    if len(moves) == 0:
+        return None, 0, []
+    order_moves(moves, board)
+    progress['root_total'] = len(moves)
+
+    board = bytes(board)
+    t1 = time()
+    if budget_ms is None:
+        deadline = None
+        depths = [depth]
+    else:
+        deadline = t1 + budget_ms / 1000
+        depths = range(1, depth + 1)
+
+    best_move, pv = moves[0], []
+    for iteration_depth in depths:
+        t_iteration = time()
+        iteration_nodes = stats.total_nodes()
+        _ALPHAS[slot] = -5000
+        progress['root_done'] = 0
+
+        def submit(move):
+            return pool.submit(_search_move, color, board, iteration_depth,
+                               castling, move['from'], move['to'], slot,
+                               pruning, evaluation)
+
+        # The first move (best so far) alone sets the bound used by the others
+        pending = {submit(moves[0]): 0}
+        started = False
+        while pending:
+            if not stop is None and stop.is_set():
+                break
+            # The first depth is always completed
+            timeout = None
+            if not deadline is None and iteration_depth > 1:
+                timeout = max(0, deadline - time())
+            if not stop is None:
+                timeout = STOP_POLL if timeout is None else \
+                    min(timeout, STOP_POLL)
+            done, _ = wait(pending, timeout, FIRST_COMPLETED)
+            if not done:
+                if not deadline is None and iteration_depth > 1 and \
+                    time() > deadline:
+                    break
+                continue
+            for future in done:
+                move = moves[pending.pop(future)]
+                move['value'], move['exact'], move['pv'], move_stats = \
+                    future.result()
+                stats.add(move_stats)
+                progress['nodes'] = stats.total_nodes()
+                progress['root_done'] += 1
+            if not started:
+                started = True
+                for n in range(1, len(moves)):
+                    pending[submit(moves[n])] = n
+        if pending:
+            # Out of time: stop running searches, keep the previous depth
+            _ALPHAS[slot] = STOP
+            for future in pending:
+                future.cancel()
+            if verbose:
+                print('Depth {}: out of time'.format(iteration_depth))
+            break
+        if not stop is None and stop.is_set():
+            break
+
+        # Best exact value: the other values are upper bounds, not above it.
+        # Exact values order the next iteration, bounds keep their order after
+        # them
+        best = max((n for n in range(len(moves)) if moves[n]['exact']),
+                   key=lambda n: moves[n]['value'])
+        best_move = moves.pop(best)
+        moves.sort(key=lambda move: (0, -move['value']) if move['exact'] else
+                   (1, 0))
+        moves.insert(0, best_move)
+        pv = best_move.pop('pv')
+        best_move = dict(best_move)
+        del best_move['exact']
+        best_move['depth'] = iteration_depth
+        progress.update(depth=iteration_depth,
+                        best=pack_move(best_move['from'], best_move['to']),
+                        score=best_move['value'])
+        stats.iterations.append({
+            'depth': iteration_depth,
+            'nodes': stats.total_nodes() - iteration_nodes,
+            'time': round(time() - t_iteration, 3),
+            'score': best_move['value'],
+        })
+        if verbose:
+            print('Depth {}: {} ({}) in {:.2f} s'.format(
+                iteration_depth, readable_line(pv), best_move['value'],
+                time() - t_iteration))
+        # Next depth is at least as long as this one
+        if abs(best_move['value']) > 900 or (
+                not deadline is None and
+                2 * time() - t_iteration > deadline):
+            break
+
+    stats.time = time() - t1
+    if verbose:
+        print('Time Elapsed: %.2f s' % stats.time)
+    return best_move, best_move.get('value', 0), pv
@@ -0,0 +1,155 @@
+"""
+Perft: counts the leaves of the legal move tree, to validate and benchmark
+the move generator.
+
+    python3 perft.py --depth 4                     # start position
+    python3 perft.py --position kiwipete --depth 3 --divide
+    python3 perft.py --fen "<fen>" --depth 3
+    python3 perft.py --test                        # compare to reference
+
+The engine knows neither en-passant nor under-promotion (pawns always become
+queens), so reference counts are the published ones minus the leaves reached
+through those moves.
+"""
+import argparse
+import sys
+from time import time
+from board import WHITE, BLACK, START_FEN, from_fen
+from utils import (
+    available_movements,
+    play,
+    unplay,
+    play_castling,
+    unplay_castling,
+    legal_masks,
+    king_position,
+    enemy,
+    readable_position,
+)
+
+POSITIONS = {
+    'start': START_FEN,
+    'kiwipete':
+    'r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1',
+    'position3': '8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - - 0 1',
+    'position4':
+    'r3k2r/Pppp1ppp/1b3nbN/nP6/BBP1P3/q4N2/Pp1P2PP/R2Q1RK1 w kq - 0 1',
+    'position5': 'rnbq1k1r/pp1Pbppp/2p5/8/2B5/8/PPP1NnPP/RNBQK2R w KQ - 1 8',
+    'position6':
+    'r4rk1/1pp1qppp/p1np1n2/2b1p1B1/2B1P1b1/P1NP1N2/1PP1QPPP/R4RK1 w - - 0 10',
+}
+
+# Leaf counts by depth, without en-passant and under-promotion
+REFERENCE = {
+    'start': [20, 400, 8902, 197281],
+    'kiwipete': [48, 2038, 97766],
+    'position3': [14, 191, 2810],
+    'position4': [6, 228, 8083],
+    'position5': [41, 1373, 54007],
+    'position6': [46, 2079, 89890],
+}
+
+def legal_moves(board, color, castling, kpos):
+    """
+    Returns the (start, arrival) legal moves of color
+    """
+    masks = legal_masks(color, board, kpos[color])
+    moves = []
+    for sq in range(64):
+        if board[sq] & color:
+            for arrival in available_movements(sq, board,
+                                               castling[color]['left'],
+                                               castling[color]['right'],
+                                               kpos=kpos, masks=masks):
+                moves.append((sq, arrival))
+    return moves
+
+def perft(board, color, castling, depth, kpos=None):
+    """
+    Number of leaves of the legal move tree of given depth
+    """
+    if kpos is None:
+        kpos = {
+            WHITE: king_position(WHITE, board),
+            BLACK: king_position(BLACK, board),
+        }
+    moves = legal_moves(board, color, castling, kpos)
+    # Bulk counting: the last ply is not played
+    if depth <= 1:
+        return len(moves) if depth == 1 else 1
+    total = 0
+    for start, arrival in moves:
+        total += _perft_move(board, color, castling, depth, kpos, start,
+                            arrival)
+    return total
+
+def _perft_move(board, color, castling, depth, kpos, start, arrival):
+    unplay_infos = play(start, arrival, board, kpos)
+    old_cast, _ = play_castling(castling, color, start, arrival)
+    count = perft(board, enemy(color), castling, depth - 1, kpos)
+    unplay_castling(castling, color, old_cast)
+    unplay(*unplay_infos, board=board, kpos=kpos)
+    return count
+
+def divide(board, color, castling, depth):
+    """
+    Leaf count per root move: {(start, arrival): count}
+    """
+    kpos = {
+        WHITE: king_position(WHITE, board),
+        BLACK: king_position(BLACK, board),
+    }
+    return {
+        (start, arrival): _perft_move(board, color, castling, depth, kpos,
+                                      start, arrival)
+        for start, arrival in legal_moves(board, color, castling, kpos)
+    }
+
+def run(fen, depth, show_divide=False):
+    """
+    Prints and returns leaf count, with the nodes/s figure
+    """
+    board, castling, turn = from_fen(fen)
+    t1 = time()
+    if show_divide:
+        counts = divide(board, turn, castling, depth)
+        for (start, arrival), count in sorted(counts.items()):
+            print('{}{}: {}'.format(readable_position(start),
+                                    readable_position(arrival), count))
+        total = sum(counts.values())
+    else:
+        total = perft(board, turn, castling, depth)
+    elapsed = time() - t1
+    print('Depth {}: {} leaves in {:.2f} s, {} n/s'.format(
+        depth, total, elapsed, int(total / max(elapsed, 1e-9))))
+    return total
+
+def test():
+    """
+    Compares counts with REFERENCE, returns the number of failures
+    """
+    failures = 0
+    for name, counts in REFERENCE.items():
+        for depth, expected in enumerate(counts, 1):
+            print('{} '.format(name), end='')
+            found = run(POSITIONS[name], depth)
+            if found != expected:
+                print('FAILED: {} expected'.format(expected))
+                failures += 1
+    print('{} failure(s)'.format(failures))
+    return failures
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--depth', type=int, default=3)
+    parser.add_argument('--position', choices=sorted(POSITIONS),
+                        default='start')
+    parser.add_argument('--fen', help='overrides --position')
+    parser.add_argument('--divide', action='store_true',
+                        help='leaf count per root move')
+    parser.add_argument('--test', action='store_true',
+                        help='check reference counts')
+    args = parser.parse_args()
+    if args.test:
+        sys.exit(int(test() > 0))
+    run(args.fen or POSITIONS[args.position], args.depth, args.divide)
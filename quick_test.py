@@ -1,25 +1,27 @@
 import pickle
+from board import upgrade_position
 from utils import *
 
 with open('2_turn_checkmate.p', 'rb') as _file:
-    board, castling, turn = pickle.load(_file)
+    board, castling, turn = upgrade_position(*pickle.load(_file))
 
 print_board(board)
 
-tree, best_index = build_tree(turn, board, 6, castling)
-
-best_elt = tree[best_index]
+best_elt, score, pv = search(turn, board, 5, castling)
 
 print("Best move: {} {} -> {}".format(
-    board[best_elt['from'][0]][best_elt['from'][1]]['type'],
-    best_elt['from'],
-    best_elt['to']))
+    TYPE_NAMES[board[best_elt['from']] & TYPE_MASK],
+    readable_position(best_elt['from']),
+    readable_position(best_elt['to'])))
+print("Line: {} ({})".format(readable_line(pv), score))
 
 """
+# Debug: whole tree of the search
+tree, best_index, stats = build_tree(turn, board, 6, castling)
 for elt in tree:
     print('{} {} -> {} ({})'.format(
-        board[elt['from'][0]][elt['from'][1]]['type'],
-        elt['from'],
-        elt['to'],
+        TYPE_NAMES[board[elt['from']] & TYPE_MASK],
+        readable_position(elt['from']),
+        readable_position(elt['to']),
         elt['score']))
 """
@@ -0,0 +1,168 @@
+"""
+Search statistics and profiling.
+
+A SearchStats given to utils.search (or build_tree, search_parallel) is
+filled during the search: nodes by ply, cutoffs, time spent generating
+moves, ordering them, detecting checks and evaluating leaves, transposition
+table and killer moves hit rates, iterations. Searches given a profile_dir
+are run under cProfile and dump a pstats file there:
+
+    python3 -m pstats profiles/search-<time>-<pid>.pstats
+"""
+import cProfile
+import os
+from time import time
+
+class SearchStats:
+    """
+    Counters of one search. Timers are in seconds
+    """
+
+    def __init__(self):
+        # Nodes searched by ply (distance to the root), quiescence ones apart
+        self.nodes = []
+        self.qnodes = 0
+        # Nodes whose moves were searched, and moves searched in them
+        self.expanded = 0
+        self.children = 0
+        # Beta cutoffs, and the ones made by the first move searched
+        self.cutoffs = 0
+        self.first_move_cutoffs = 0
+        # Transposition table probes, hits, cutoffs
+        self.tt = [0, 0, 0]
+        # Killer moves searched, and cutoffs they made
+        self.killers = [0, 0]
+        # Move generation, move ordering, check detection, leaf evaluation
+        self.timers = [0.0, 0.0, 0.0, 0.0]
+        # Null moves searched, null move cutoffs, late moves reduced, reduced
+        # moves searched again, futile moves skipped
+        self.pruning = [0, 0, 0, 0, 0]
+        # Null window searches (principal variation search), the ones
+        # searched again with the full window, aspiration fail lows and fail
+        # highs (root searched again)
+        self.researches = [0, 0, 0, 0]
+        # {'depth', 'nodes', 'time', 'score'} of each completed iteration
+        self.iterations = []
+        self.time = 0.0
+        self.started = time()
+        # pstats file of the search, if profiled
+        self.profile = None
+
+    def total_nodes(self):
+        return sum(self.nodes) + self.qnodes
+
+    def add(self, other):
+        """
+        Adds the counters of another search of the same position (a root
+        move searched by a worker)
+        """
+        if len(self.nodes) < len(other.nodes):
+            self.nodes += [0] * (len(other.nodes) - len(self.nodes))
+        for ply, count in enumerate(other.nodes):
+            self.nodes[ply] += count
+        self.qnodes += other.qnodes
+        self.expanded += other.expanded
+        self.children += other.children
+        self.cutoffs += other.cutoffs
+        self.first_move_cutoffs += other.first_move_cutoffs
+        for stat in ('tt', 'killers', 'timers', 'pruning', 'researches'):
+            mine = getattr(self, stat)
+            for n, value in enumerate(getattr(other, stat)):
+                mine[n] += value
+
+    def as_dict(self):
+        """
+        JSON ready counters, with rates
+        """
+        def rate(part, whole):
+            return round(part / whole, 4) if whole else 0
+
+        nodes = self.total_nodes()
+        nodes_by_ply = list(self.nodes)
+        while nodes_by_ply and not nodes_by_ply[-1]:
+            nodes_by_ply.pop()
+        iteration_nodes = [iteration['nodes'] for iteration in self.iterations]
+        return {
+            'started': self.started,
+            'time': round(self.time, 3),
+            'nodes': nodes,
+            'nps': int(nodes / self.time) if self.time else 0,
+            'nodes_by_ply': nodes_by_ply,
+            'qnodes': self.qnodes,
+            'cutoffs': self.cutoffs,
+            'first_move_cutoff_rate': rate(self.first_move_cutoffs,
+                                           self.cutoffs),
+            'time_movegen': round(self.timers[0], 3),
+            'time_ordering': round(self.timers[1], 3),
+            'time_check': round(self.timers[2], 3),
+            'time_evaluation': round(self.timers[3], 3),
+            'tt_probes': self.tt[0],
+            'tt_hit_rate': rate(self.tt[1], self.tt[0]),
+            'tt_cutoff_rate': rate(self.tt[2], self.tt[0]),
+            'killer_hit_rate': rate(self.killers[1], self.killers[0]),
+            'null_moves': self.pruning[0],
+            'null_move_cutoff_rate': rate(self.pruning[1], self.pruning[0]),
+            'reductions': self.pruning[2],
+            'reduction_research_rate': rate(self.pruning[3],
+                                            self.pruning[2]),
+            'futile_moves': self.pruning[4],
+            'null_window_searches': self.researches[0],
+            'pvs_researches': self.researches[1],
+            'aspiration_fail_lows': self.researches[2],
+            'aspiration_fail_highs': self.researches[3],
+            # Moves searched by expanded node
+            'branching_factor': rate(self.children, self.expanded),
+            # Growth of the nodes from an iteration to the next one
+            'effective_branching_factor': [
+                rate(iteration_nodes[n], iteration_nodes[n - 1])
+                for n in range(1, len(iteration_nodes))],
+            'iterations': self.iterations,
+            'profile': self.profile,
+        }
+
+    def summary(self):
+        """
+        Text report, as printed by verbose searches
+        """
+        stats = self.as_dict()
+        return '\n'.join([
+            'Nodes by ply: {} (+{} quiescence)'.format(stats['nodes_by_ply'],
+                                                       stats['qnodes']),
+            'Cutoffs: {}, {:.0%} on the first move'.format(
+                stats['cutoffs'], stats['first_move_cutoff_rate']),
+            'Time: {:.2f} s movegen, {:.2f} s ordering, {:.2f} s check, '
+            '{:.2f} s evaluation'.format(
+                stats['time_movegen'], stats['time_ordering'],
+                stats['time_check'], stats['time_evaluation']),
+            'Hit rates: TT {:.0%}, killers {:.0%}'.format(
+                stats['tt_hit_rate'], stats['killer_hit_rate']),
+            'Pruning: {} null moves ({:.0%} cut), {} reductions ({:.0%} '
+            'searched again), {} futile moves'.format(
+                stats['null_moves'], stats['null_move_cutoff_rate'],
+                stats['reductions'], stats['reduction_research_rate'],
+                stats['futile_moves']),
+            'Re-searches: {} of {} null window searches, aspiration {} fail '
+            'low, {} fail high'.format(
+                stats['pvs_researches'], stats['null_window_searches'],
+                stats['aspiration_fail_lows'],
+                stats['aspiration_fail_highs']),
+            'Branching factor: {}, effective {}'.format(
+                stats['branching_factor'],
+                stats['effective_branching_factor']),
+        ])
+
+def profiled(profile_dir, stats, run, *args, **kwargs):
+    """
+    Returns run(*args, **kwargs), run under cProfile. The pstats file is
+    written in profile_dir, its path stored in stats (if not None)
+    """
+    os.makedirs(profile_dir, exist_ok=True)
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(run, *args, **kwargs)
+    finally:
+        path = os.path.join(profile_dir, 'search-{}-{}.pstats'.format(
+            int(time() * 1000), os.getpid()))
+        profiler.dump_stats(path)
+        if not stats is None:
+            stats.profile = path
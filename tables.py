@@ -0,0 +1,67 @@
+"""
+Attack and ray tables, computed once at import so that move generation and
+check detection never do bounds arithmetic.
+All tables are indexed by square (8 * row + col).
+"""
+from board import WHITE, BLACK, ROOK, BISHOP
+
+# Ray directions: rook ones first, then bishop ones
+DIRECTIONS = [(1, 0), (-1, 0), (0, 1), (0, -1),
+              (1, 1), (-1, 1), (-1, -1), (1, -1)]
+# Slider type moving along each direction (the queen moves along all of them)
+DIRECTION_SLIDERS = [ROOK] * 4 + [BISHOP] * 4
+KNIGHT_OFFSETS = [(2, 1), (2, -1), (-2, 1), (-2, -1), (1, 2), (-1, 2),
+                  (1, -2), (-1, -2)]
+
+def _squares_from(sq, offsets, repeat):
+    """
+    For each offset, squares reached from sq (a single one if not repeat)
+    """
+    row, col = sq >> 3, sq & 7
+    to_return = []
+    for addr, addc in offsets:
+        squares = []
+        r, c = row + addr, col + addc
+        while -1 < r < 8 and -1 < c < 8:
+            squares.append(8 * r + c)
+            if not repeat:
+                break
+            r += addr
+            c += addc
+        to_return.append(tuple(squares))
+    return to_return
+
+# RAYS[sq][d]: squares from sq (excluded) to the edge along DIRECTIONS[d]
+RAYS = [_squares_from(sq, DIRECTIONS, True) for sq in range(64)]
+# Non empty rays only, per slider
+ROOK_RAYS = [tuple(ray for ray in RAYS[sq][:4] if ray) for sq in range(64)]
+BISHOP_RAYS = [tuple(ray for ray in RAYS[sq][4:] if ray) for sq in range(64)]
+QUEEN_RAYS = [ROOK_RAYS[sq] + BISHOP_RAYS[sq] for sq in range(64)]
+
+KNIGHT_TARGETS = [
+    tuple(sq for (sq,) in filter(None, _squares_from(start, KNIGHT_OFFSETS,
+                                                     False)))
+    for start in range(64)
+]
+KING_TARGETS = [
+    tuple(sq for (sq,) in filter(None, _squares_from(start, DIRECTIONS,
+                                                     False)))
+    for start in range(64)
+]
+
+# PAWN_ATTACKS[color][sq]: squares attacked by a pawn of color on sq. It is
+# also where enemy pawns attacking a color's king on sq stand.
+PAWN_ATTACKS = {
+    WHITE: [tuple(sq for (sq,) in filter(None, _squares_from(
+        start, [(-1, -1), (-1, 1)], False))) for start in range(64)],
+    BLACK: [tuple(sq for (sq,) in filter(None, _squares_from(
+        start, [(1, -1), (1, 1)], False))) for start in range(64)],
+}
+
+# DIRECTION_TO[64 * from + to]: index of the ray of from that contains to, -1
+# if they are not aligned
+DIRECTION_TO = [-1] * 4096
+for _start in range(64):
+    for _d, _ray in enumerate(RAYS[_start]):
+        for _sq in _ray:
+            DIRECTION_TO[64 * _start + _sq] = _d
@@ -0,0 +1,95 @@
+"""
+Fixed size transposition table.
+
+Entries are stored in flat arrays (no Python object per entry) so the memory
+used is set once at creation and never grows, whatever the number of searches.
+"""
+from array import array
+
+# Bound types
+EXACT = 0
+LOWER = 1
+UPPER = 2
+
+# key (8) + score (8) + move (2) + depth, flag and generation (1 each)
+ENTRY_BYTES = 21
+
+NO_MOVE = 0
+
+def pack_move(start, arrival):
+    """
+    (start, arrival) squares -> int stored in the table
+    """
+    return start << 6 | arrival
+
+def unpack_move(move):
+    """
+    Inverse of pack_move
+    """
+    return move >> 6, move & 63
+
+class TranspositionTable:
+    """
+    Buckets of two entries: the first one is depth-preferred (only replaced by
+    a deeper search or by an entry of a newer search), the second one is always
+    replaced.
+    Scores are stored from white's point of view.
+    """
+
+    def __init__(self, size_mb=16):
+        self.buckets = max(1, size_mb * 2**20 // (2 * ENTRY_BYTES))
+        size = 2 * self.buckets
+        self.keys = array('Q', bytes(8 * size))
+        self.scores = array('d', bytes(8 * size))
+        self.moves = array('H', bytes(2 * size))
+        self.depths = array('b', bytes(size))
+        self.flags = array('b', bytes(size))
+        self.generations = array('B', bytes(size))
+        self.generation = 0
+
+    def new_search(self):
+        """
+        To be called before each search, makes older entries replaceable
+        """
+        self.generation = (self.generation + 1) & 255
+
+    def clear(self):
+        size = 2 * self.buckets
+        self.keys = array('Q', bytes(8 * size))
+        self.generations = array('B', bytes(size))
+
+    def probe(self, key):
+        """
+        Returns (depth, flag, score, move) stored for key, or None
+        """
+        index = 2 * (key % self.buckets)
+        if self.keys[index] != key:
+            index += 1
+            if self.keys[index] != key:
+                return None
+        return (self.depths[index], self.flags[index], self.scores[index],
+                self.moves[index])
+
+    def store(self, key, depth, flag, score, move):
+        index = 2 * (key % self.buckets)
+        if self.keys[index] != key and \
+            self.generations[index] == self.generation and \
+            self.depths[index] > depth:
+            index += 1
+        self.keys[index] = key
+        self.depths[index] = depth
+        self.flags[index] = flag
+        self.scores[index] = score
+        self.moves[index] = move
+        self.generations[index] = self.generation
+
+    def usage(self):
+        """
+        Permill of the first 1000 entries filled during the current search
+        """
+        sample = min(1000, 2 * self.buckets)
+        used = 0
+        for index in range(sample):
+            if self.generations[index] == self.generation and self.keys[index]:
+                used += 1
+        return 1000 * used // sample
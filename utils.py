@@ -1,295 +1,371 @@
-from time import time
-from copy import deepcopy
+from time import time, perf_counter
 from random import shuffle
+from board import (
+    EMPTY,
+    PAWN,
+    KNIGHT,
+    BISHOP,
+    ROOK,
+    QUEEN,
+    KING,
+    TYPE_MASK,
+    WHITE,
+    BLACK,
+    COLOR_MASK,
+    TYPE_NAMES,
+    ZOBRIST,
+    ZOBRIST_SIDE,
+    ZOBRIST_CASTLING,
+    position_hash,
+)
+from evaluation import (
+    PHASE_KEYS,
+    score_leaf,
+    score_batch,
+    game_phase,
+    piece_square_tables,
+)
+from transposition import (
+    TranspositionTable,
+    EXACT,
+    LOWER,
+    UPPER,
+    NO_MOVE,
+    pack_move,
+    unpack_move,
+)
+from tables import (
+    RAYS,
+    ROOK_RAYS,
+    BISHOP_RAYS,
+    QUEEN_RAYS,
+    KNIGHT_TARGETS,
+    KING_TARGETS,
+    PAWN_ATTACKS,
+    DIRECTION_TO,
+    DIRECTION_SLIDERS,
+)
+from stats import SearchStats, profiled
+
+# Indexed by piece type
+PIECE_VALUES = [0, 1, 3, 3, 5, 9, 0]
+# Pawns are always promoted to queens
+PROMOTION_GAIN = PIECE_VALUES[QUEEN] - PIECE_VALUES[PAWN]
+
+SLIDER_RAYS = {
+    ROOK: ROOK_RAYS,
+    BISHOP: BISHOP_RAYS,
+    QUEEN: QUEEN_RAYS,
+}
+# Row from where pawns can go 2 squares ahead
+PAWN_START_ROW = {WHITE: 6, BLACK: 1}
+
+# Search depth limit when only a time budget is given
+MAX_DEPTH = 32
+
+# Move ordering keys (higher first). Quiet moves are ordered by their history
+# score, kept below ORDER_COUNTER
+ORDER_HASH = 1 << 30
+ORDER_CAPTURE = 1 << 20
+ORDER_KILLER = 1 << 19
+ORDER_COUNTER = ORDER_KILLER - 2
+HISTORY_MAX = 1 << 18
+# Quiescence search: margin added to a capture gain before pruning it
+DELTA_MARGIN = 2
+# Quiescence search: plies where all check evasions are searched (then a
+# checked side only considers captures, which bounds check sequences)
+EVASION_PLIES = 2
+
+# First square of each color's back rank
+BACK_RANK_START = {WHITE: 56, BLACK: 0}
+# Squares of each color's seventh rank (its pawns there may promote)
+SEVENTH_RANK = {WHITE: slice(8, 16), BLACK: slice(48, 56)}
+# Kings and rooks starting squares: only moves from or to them can change
+# castling rights
+CASTLING_SQUARES = frozenset((0, 4, 7, 56, 60, 63))
+# Shared rights dicts, by (left, right): play_castling never builds new ones.
+# Rights dicts are replaced, never modified
+CASTLING_RIGHTS = {
+    (left, right): {'left': left, 'right': right}
+    for left in (False, True) for right in (False, True)
+}
+# play_castling result of a move not changing any right
+NO_CASTLING_CHANGE = (None, 0)
+
+# Selective search features used by default (see search's pruning):
+#   null_move: give the move to the opponent, searched NULL_REDUCTION plies
+#       less deep. If the side to move is still above beta, cut
+#   lmr: late move reductions, quiet moves ordered after LMR_MOVES others are
+#       first searched a ply less deep (searched again if they raise alpha)
+#   futility: quiet moves one ply from the leaves that cannot bring the
+#       score within FUTILITY_MARGIN of alpha are not searched
+PRUNING = frozenset(('null_move', 'lmr', 'futility'))
+NULL_REDUCTION = 2
+# Width of the null windows (null move and principal variation search):
+# below the difference between two scores (piece-square tables are rounded
+# to centipawns)
+NULL_WINDOW = 0.001
+LMR_MOVES = 3
+LMR_MIN_DEPTH = 3
+FUTILITY_MARGIN = 1
+# Iterations after the first one search the root within ASPIRATION_WINDOW of
+# the previous score, doubled on each fail low/high. Past ASPIRATION_MAX the
+# failing side of the window is opened
+ASPIRATION_WINDOW = 0.5
+ASPIRATION_MAX = 4
+# Leaf scores (see search's evaluation):
+#   material: the material balance (with the castling bonuses), updated
+#       move by move
+#   piece_square: plus the tapered piece-square tables (see evaluation.py)
+#       of the searched position's game phase, updated move by move too
+#   batch: plus mobility, the leaves of a node one ply from them being
+#       evaluated in one go
+EVALUATIONS = ('material', 'piece_square', 'batch')
+EVALUATION = 'piece_square'
 
 def available_movements_raw(location, board):
     """
-    Takes a location and a board and return the available moves as a series of
-    arrival position tuple.
+    Takes a location (square index) and a board and return the available moves
+    as a series of arrival squares.
     WARNING: does not take into account check
-    TODO: add castling and en-passant
-    """
-
-    typ = board[location[0]][location[1]].get('type')
-    col = board[location[0]][location[1]]['color']
-
-    if typ == 'rook' or typ == 'queen':
-        # down
-        r, c = location[0] + 1, location[1]
-        while r < 8 and board[r][c]['color'] == 'blank':
-            yield (r, c)
-            r += 1
-        if r < 8 and board[r][c]['color'] != col:
-            yield (r, c)
-        # up
-        r, c = location[0] - 1, location[1]
-        while r > -1 and board[r][c]['color'] == 'blank':
-            yield (r, c)
-            r -= 1
-        if r > -1 and board[r][c]['color'] != col:
-            yield (r, c)
-        # right
-        r, c = location[0], location[1] + 1
-        while c < 8 and board[r][c]['color'] == 'blank':
-            yield (r, c)
-            c += 1
-        if c < 8 and board[r][c]['color'] != col:
-            yield (r, c)
-        # left
-        r, c = location[0], location[1] - 1
-        while c > -1 and board[r][c]['color'] == 'blank':
-            yield (r, c)
-            c -= 1
-        if c > -1 and board[r][c]['color'] != col:
-            yield (r, c)
-
-    if typ == 'bishop' or typ == 'queen':
-        # downright
-        r, c = location[0] + 1, location[1] + 1
-        while r < 8 and c < 8 and board[r][c]['color'] == 'blank':
-            yield (r, c)
-            r += 1
-            c += 1
-        if r < 8 and c < 8 and board[r][c]['color'] != col:
-            yield (r, c)
-        # upright
-        r, c = location[0] - 1, location[1] + 1
-        while r > -1 and c < 8 and board[r][c]['color'] == 'blank':
-            yield (r, c)
-            r -= 1
-            c += 1
-        if r > -1 and c < 8 and board[r][c]['color'] != col:
-            yield (r, c)
-        # upleft
-        r, c = location[0] - 1, location[1] - 1
-        while r > -1 and c > -1 and board[r][c]['color'] == 'blank':
-            yield (r, c)
-            r -= 1
-            c -= 1
-        if r > -1 and c > -1 and board[r][c]['color'] != col:
-            yield (r, c)
-        # downleft
-        r, c = location[0] + 1, location[1] - 1
-        while r < 8 and c > -1 and board[r][c]['color'] == 'blank':
-            yield (r, c)
-            r += 1
-            c -= 1
-        if r < 8 and c > -1 and board[r][c]['color'] != col:
-            yield (r, c)
-
-    elif typ == 'pawn':
-        # black: +1 / white: -1
-        _sense = int(col == 'black')*2 - 1
+    TODO: add en-passant
+    """
+
+    piece = board[location]
+    typ = piece & TYPE_MASK
+    col = piece & COLOR_MASK
+
+    if typ == ROOK or typ == BISHOP or typ == QUEEN:
+        for ray in SLIDER_RAYS[typ][location]:
+            for sq in ray:
+                target = board[sq]
+                if target == EMPTY:
+                    yield sq
+                else:
+                    if not target & col:
+                        yield sq
+                    break
+
+    elif typ == PAWN:
+        # black: +8 / white: -8
+        if col == BLACK:
+            step = 8
+        else:
+            step = -8
+        ahead = location + step
 
         # Straight
-        if board[location[0] + _sense][location[1]]['color'] == 'blank':
-            yield (location[0] + _sense, location[1])
+        if board[ahead] == EMPTY:
+            yield ahead
             # 2 straight
-            if location[0] == 6 and col == 'white' and \
-                board[4][location[1]]['color'] == 'blank':
-                yield (4, location[1])
-            elif location[0] == 1 and col == 'black' and \
-                board[3][location[1]]['color'] == 'blank':
-                yield (3, location[1])
-            else:
-                pass
-        # Kill an enemy (left)
-        if location[1] != 0 and \
-            board[location[0] + _sense][location[1] - 1]['color'] == enemy(col):
-            yield (location[0] + _sense, location[1] - 1)
-        # Kill an enemy (right)
-        if location[1] != 7 and \
-            board[location[0] + _sense][location[1] + 1]['color'] == enemy(col):
-            yield (location[0] + _sense, location[1] + 1)
-
-    elif typ == 'knight':
-        knight_moves = [(2, 1), (2, -1), (-2, 1), (-2, -1), (1, 2), (-1, 2),
-                        (1, -2), (-1, -2)]
-        for addr, addc in knight_moves:
-            nr, nc = location[0] + addr, location[1] + addc
-            if nr < 8 and nc < 8 and nr > -1 and nc > -1 and \
-                board[nr][nc]['color'] != col:
-                yield(nr, nc)
-
-    elif typ == 'king':
-        for addr in range(-1, 2):
-            for addc in range(-1, 2):
-                if not (addr == 0 and addc == 0):
-                    nr, nc = location[0] + addr, location[1] + addc
-                    if nr < 8 and nc < 8 and nr > -1 and nc > -1 and \
-                        board[nr][nc]['color'] != col:
-                        yield(nr, nc)
+            if location >> 3 == PAWN_START_ROW[col] and \
+                board[ahead + step] == EMPTY:
+                yield ahead + step
+        # Kill an enemy
+        enemy_col = col ^ COLOR_MASK
+        for sq in PAWN_ATTACKS[col][location]:
+            if board[sq] & enemy_col:
+                yield sq
+
+    elif typ == KNIGHT or typ == KING:
+        if typ == KNIGHT:
+            targets = KNIGHT_TARGETS[location]
+        else:
+            targets = KING_TARGETS[location]
+        for sq in targets:
+            if not board[sq] & col:
+                yield sq
+
+def legal_masks(color, board, ksq):
+    """
+    Computed once per position for the legal move generation of color, whose
+    king is on ksq. Returns check_mask, pins:
+        check_mask: None if not in check, else the squares where a piece can
+        go to stop the check (empty if double check: king moves only)
+        pins: {pinned piece square: squares it can go to}
+    """
+    enemy_col = color ^ COLOR_MASK
+    check_mask = None
+    pins = {}
+    for direction, ray in enumerate(RAYS[ksq]):
+        slider = DIRECTION_SLIDERS[direction]
+        pinned = -1
+        for n, sq in enumerate(ray):
+            _piece = board[sq]
+            if not _piece:
+                continue
+            if _piece & color:
+                if pinned != -1:
+                    break
+                pinned = sq
+                continue
+            if _piece & TYPE_MASK == slider or _piece & TYPE_MASK == QUEEN:
+                if pinned != -1:
+                    pins[pinned] = frozenset(ray[:n + 1])
+                elif check_mask is None:
+                    check_mask = frozenset(ray[:n + 1])
+                else:
+                    check_mask = frozenset()
+            break
+    enemy_knight = enemy_col | KNIGHT
+    for sq in KNIGHT_TARGETS[ksq]:
+        if board[sq] == enemy_knight:
+            check_mask = frozenset((sq,)) if check_mask is None else \
+                frozenset()
+    enemy_pawn = enemy_col | PAWN
+    for sq in PAWN_ATTACKS[color][ksq]:
+        if board[sq] == enemy_pawn:
+            check_mask = frozenset((sq,)) if check_mask is None else \
+                frozenset()
+    return check_mask, pins
 
 def available_movements(location, board, castling_left=False,
-                        castling_right=False, kpos=None, am_i_check=None):
+                        castling_right=False, kpos=None, masks=None):
     """
     Take a departure location and a board and returns a list of possible arrival
     positions, using available_movements_raw, but taking check into account
-    fast_is_check only works if the king isn't moved and you are not already
-    check
+    masks are the legal_masks of the position, computed if None
+    The board is never modified
     """
-    to_return = []
-    color = board[location[0]][location[1]]['color']
-
-    if am_i_check is None:
-        am_i_check = is_check2(color, board, kpos)
-
-    if am_i_check:
-        castling_left = castling_right = False
-
-    use_slow = am_i_check or board[location[0]][location[1]]['type'] == 'king'
-
-    for arrival in available_movements_raw(location, board):
-
-        if use_slow:
-            unplay_infos = play(location, arrival, board, kpos)
-            if not is_check2(color, board, kpos):
-                to_return.append(arrival)
-            unplay(*unplay_infos, board=board, kpos=kpos)
-
-        else:
-            if not fast_is_check2(color, board, location, arrival, kpos):
-                to_return.append(arrival)
-
+    color = board[location] & COLOR_MASK
+    if not color:
+        return []
+    if kpos is None:
+        ksq = king_position(color, board)
+    else:
+        ksq = kpos[color]
+    if masks is None:
+        masks = legal_masks(color, board, ksq)
+    check_mask, pins = masks
+
+    if location != ksq:
+        if check_mask is None:
+            pin_mask = pins.get(location)
+            if pin_mask is None:
+                return list(available_movements_raw(location, board))
+            return [arrival for arrival in
+                    available_movements_raw(location, board)
+                    if arrival in pin_mask]
+        # Evasion: block or take the checker (never with a pinned piece)
+        if not check_mask or location in pins:
+            return []
+        return [arrival for arrival in available_movements_raw(location, board)
+                if arrival in check_mask]
+
+    # King: arrival must not be attacked, the king leaving its square
+    enemy_col = color ^ COLOR_MASK
+    to_return = [arrival for arrival in available_movements_raw(location, board)
+                 if not square_attacked(board, arrival, enemy_col, location)]
 
     # Add castling moves (only king move, play() will deduce and move the rook)
-    if board[location[0]][location[1]]['type'] == 'king' and \
-        (castling_left or castling_right):
-        row = location[0]
-        # If left castling is available and there is no "obstacle" -> go
-        if castling_left and board[row][1]['color'] == 'blank' and \
-            board[row][2]['color'] == 'blank' and \
-            board[row][3]['color'] == 'blank':
-            # Check if in check on the way
-            unplay_infos = play(location, (row, location[1] - 1), board, kpos)
-            if not is_check2(color, board, kpos):
-                # Check if not checked at arrival
-                unplay_infos2 = play((row, location[1] - 1),
-                                     (row, location[1] - 2), board, kpos)
-                if not is_check2(color, board, kpos):
-                    to_return.append((row, location[1] - 2))
-                unplay(*unplay_infos2, board=board, kpos=kpos)
-            unplay(*unplay_infos, board=board, kpos=kpos)
-
-        # If right castling is available and there is no "obstacle" -> go
-        if castling_right and board[row][5]['color'] == 'blank' and \
-            board[row][6]['color'] == 'blank':
-            # Check if in check on the way
-            unplay_infos = play(location, (row, location[1] + 1), board, kpos)
-            if not is_check2(color, board, kpos):
-                # Check if not checked at arrival
-                unplay_infos2 = play((row, location[1] + 1),
-                                     (row, location[1] + 2), board, kpos)
-                if not is_check2(color, board, kpos):
-                    to_return.append((row, location[1] + 2))
-                unplay(*unplay_infos2, board=board, kpos=kpos)
-            unplay(*unplay_infos, board=board, kpos=kpos)
+    if check_mask is None and (castling_left or castling_right):
+        row_start = location & ~7
+        # If left castling is available and there is no "obstacle" and no
+        # check on the way -> go
+        if castling_left and board[row_start + 1] == EMPTY and \
+            board[row_start + 2] == EMPTY and \
+            board[row_start + 3] == EMPTY and \
+            not square_attacked(board, location - 1, enemy_col) and \
+            not square_attacked(board, location - 2, enemy_col):
+            to_return.append(location - 2)
+
+        # If right castling is available and there is no "obstacle" and no
+        # check on the way -> go
+        if castling_right and board[row_start + 5] == EMPTY and \
+            board[row_start + 6] == EMPTY and \
+            not square_attacked(board, location + 1, enemy_col) and \
+            not square_attacked(board, location + 2, enemy_col):
+            to_return.append(location + 2)
 
     return to_return
 
-def play(start, arrival, board, kpos=None):
+def play(start, arrival, board, kpos=None, zkey=None):
     """
     Puts piece located at start at arrival position, MODIFIES board
+    If given, zkey ([hash]) is updated with the move and the side change
     TODO: add piece creation
     """
-    former_start = board[start[0]][start[1]]
-    former_arrival = board[arrival[0]][arrival[1]]
-    board[arrival[0]][arrival[1]] = former_start
-    board[start[0]][start[1]] = {'color': 'blank'}
+    former_start = board[start]
+    former_arrival = board[arrival]
+    board[arrival] = former_start
+    board[start] = EMPTY
+    typ = former_start & TYPE_MASK
     # If pawn at edge: transform it into a queen by default
-    if former_start['type'] == 'pawn' and (arrival[0] == 0 or arrival[0] == 7):
-        # Recreate an object to avoid side effects
-        board[arrival[0]][arrival[1]] = {
-            'type': 'queen',
-            'color': former_start['color'],
-        }
-    # If king castling: move also the rook:
-    if former_start['type'] == 'king' and abs(start[1] - arrival[1]) == 2:
+    if typ == PAWN and (arrival < 8 or arrival > 55):
+        board[arrival] = (former_start & COLOR_MASK) | QUEEN
+    elif typ == KING:
+        # If king castling: move also the rook:
         # Left castling
-        if arrival[1] == 2:
-            board[start[0]][3] = {
-                'type': 'rook',
-                'color': former_start['color']
-            }
-            board[start[0]][0] = {'color': 'blank'}
+        if start - arrival == 2:
+            board[start - 1] = (former_start & COLOR_MASK) | ROOK
+            board[start - 4] = EMPTY
         # Right castling
-        if arrival[1] == 6:
-            board[start[0]][5] = {
-                'type': 'rook',
-                'color': former_start['color']
-            }
-            board[start[0]][7] = {'color': 'blank'}
+        elif arrival - start == 2:
+            board[start + 1] = (former_start & COLOR_MASK) | ROOK
+            board[start + 3] = EMPTY
+        # Update kpos
+        if not kpos is None:
+            kpos[former_start & COLOR_MASK] = arrival
 
-    # Update kpos
-    if not kpos is None and former_start['type'] == 'king':
-        kpos[former_start['color']] = arrival
+    if not zkey is None:
+        zkey[0] ^= _move_hash(start, former_start, arrival, former_arrival,
+                              board)
 
     return start, former_start, arrival, former_arrival
 
-def unplay(start, former_start, arrival, former_arrival, board, kpos=None):
+def unplay(start, former_start, arrival, former_arrival, board, kpos=None,
+           zkey=None):
     """
     Undo the efect of the play() function. MODIFIES board
     """
-    board[start[0]][start[1]] = former_start
-    board[arrival[0]][arrival[1]] = former_arrival
-    # If king castling: move also the rook:
-    if former_start['type'] == 'king' and abs(start[1] - arrival[1]) == 2:
+    if not zkey is None:
+        zkey[0] ^= _move_hash(start, former_start, arrival, former_arrival,
+                              board)
+    board[start] = former_start
+    board[arrival] = former_arrival
+    if former_start & TYPE_MASK == KING:
+        # If king castling: move also the rook:
         # Left castling
-        if arrival[1] == 2:
-            board[start[0]][0] = {
-                'type': 'rook',
-                'color': former_start['color']
-            }
-            board[start[0]][3] = {'color': 'blank'}
+        if start - arrival == 2:
+            board[start - 4] = (former_start & COLOR_MASK) | ROOK
+            board[start - 1] = EMPTY
         # Right castling
-        if arrival[1] == 6:
-            board[start[0]][7] = {
-                'type': 'rook',
-                'color': former_start['color']
-            }
-            board[start[0]][5] = {'color': 'blank'}
-
-    # If kpos given, update it:
-    if not kpos is None and former_start['type'] == 'king':
-        kpos[former_start['color']] = start
-
-def score_per_play(arrival, board):
-    """
-    Return positive score gain if movement kills a piece, else 0
-    TODO: take into account piece creation
-    """
-    _type = board[arrival[0]][arrival[1]].get('type')
-    if _type is None:
-        return 0
-    elif _type == 'pawn':
-        return 1
-    elif _type == 'knight' or _type == 'bishop':
-        return 3
-    elif _type == 'rook':
-        return 5
-    elif _type == 'queen':
-        return 9
-    return 0
+        elif arrival - start == 2:
+            board[start + 3] = (former_start & COLOR_MASK) | ROOK
+            board[start + 1] = EMPTY
+        # If kpos given, update it:
+        if not kpos is None:
+            kpos[former_start & COLOR_MASK] = start
+
+def _move_hash(start, former_start, arrival, former_arrival, board):
+    """
+    Zobrist delta of a move, board being the one just after play()
+    """
+    delta = ZOBRIST_SIDE ^ ZOBRIST[64 * former_start + start] ^ \
+        ZOBRIST[64 * former_arrival + arrival] ^ \
+        ZOBRIST[64 * board[arrival] + arrival]
+    if former_start & TYPE_MASK == KING and abs(start - arrival) == 2:
+        rook = 64 * ((former_start & COLOR_MASK) | ROOK)
+        if start > arrival:
+            delta ^= ZOBRIST[rook + start - 4] ^ ZOBRIST[rook + start - 1]
+        else:
+            delta ^= ZOBRIST[rook + start + 3] ^ ZOBRIST[rook + start + 1]
+    return delta
 
 def king_position(color, board):
     """
     Takes a color and a board and return the color's king location
     """
-    for r, row in enumerate(board):
-        for c, piece in enumerate(row):
-            if piece.get('type') == 'king' and piece['color'] == color:
-                return r, c
-    return None
+    sq = board.find(color | KING)
+    if sq == -1:
+        return None
+    return sq
 
 def enemy(color):
     """
     'inverts' the color
     """
-    if color == 'white':
-        return 'black'
-    elif color == 'black':
-        return 'white'
-    return None
+    return color ^ COLOR_MASK
 
 def is_check2(color, board, kpos=None):
     """
@@ -297,143 +373,49 @@ def is_check2(color, board, kpos=None):
     Takes a color and a board and returns a boolean whether the player is check
     or not
     """
-    enemy_col = enemy(color)
     if kpos is None:
-        rkg, ckg = king_position(color, board)
+        ksq = king_position(color, board)
     else:
-        rkg, ckg = kpos[color]
-    # Down Right diag
-    dist = 1
-    while rkg + dist < 8 and ckg + dist < 8 and \
-        board[rkg + dist][ckg + dist]['color'] == 'blank':
-        dist += 1
-    if rkg + dist < 8 and ckg + dist < 8:
-        _piece = board[rkg + dist][ckg + dist]
-        _type = _piece['type']
-        if _piece['color'] == enemy_col and (
-                _type == 'queen' or
-                _type == 'bishop' or
-                (dist == 1 and (
-                    _type == 'king' or
-                    (color == 'black' and _type == 'pawn')
-                ))
-        ):
-            return True
-
-    # Down Left diag
-    dist = 1
-    while rkg + dist < 8 and ckg - dist >= 0 and \
-        board[rkg + dist][ckg - dist]['color'] == 'blank':
-        dist += 1
-    if rkg + dist < 8 and ckg - dist >= 0:
-        _piece = board[rkg + dist][ckg - dist]
-        _type = _piece['type']
-        if _piece['color'] == enemy_col and (
-                _type == 'queen' or
-                _type == 'bishop' or
-                (dist == 1 and (
-                    _type == 'king' or
-                    (color == 'black' and _type == 'pawn')
-                ))
-        ):
-            return True
-
-    # Up Left diag
-    dist = 1
-    while rkg - dist >= 0 and ckg - dist >= 0 and \
-        board[rkg - dist][ckg - dist]['color'] == 'blank':
-        dist += 1
-    if rkg - dist >= 0 and ckg - dist >= 0:
-        _piece = board[rkg - dist][ckg - dist]
-        _type = _piece['type']
-        if _piece['color'] == enemy_col and (
-                _type == 'queen' or
-                _type == 'bishop' or
-                (dist == 1 and (
-                    _type == 'king' or
-                    (color == 'white' and _type == 'pawn')
-                ))
-        ):
-            return True
-
-    # Up Right diag
-    dist = 1
-    while rkg - dist >= 0 and ckg + dist < 8 and \
-        board[rkg - dist][ckg + dist]['color'] == 'blank':
-        dist += 1
-    if rkg - dist >= 0 and ckg + dist < 8:
-        _piece = board[rkg - dist][ckg + dist]
-        _type = _piece['type']
-        if _piece['color'] == enemy_col and (
-                _type == 'queen' or
-                _type == 'bishop' or
-                (dist == 1 and (
-                    _type == 'king' or
-                    (color == 'white' and _type == 'pawn')
-                ))
-        ):
-            return True
+        ksq = kpos[color]
+    return square_attacked(board, ksq, color ^ COLOR_MASK)
 
-    # Up line
-    dist = 1
-    while rkg - dist >= 0 and board[rkg - dist][ckg]['color'] == 'blank':
-        dist += 1
-    if rkg - dist >= 0:
-        _piece = board[rkg - dist][ckg]
-        if _piece['color'] == enemy_col and (
-                _piece['type'] == 'queen' or
-                _piece['type'] == 'rook' or
-                (dist == 1 and _piece['type'] == 'king')
-        ):
-            return True
+def square_attacked(board, target, enemy_col, ignore=-1):
+    """
+    Whether a piece of enemy_col attacks the target square, the ignore square
+    being seen as empty (a king moving away along the attack line)
+    """
+    # Lines
+    for ray in ROOK_RAYS[target]:
+        for sq in ray:
+            _piece = board[sq]
+            if _piece and sq != ignore:
+                if _piece & enemy_col and (_piece & TYPE_MASK == ROOK or
+                                           _piece & TYPE_MASK == QUEEN):
+                    return True
+                break
 
-    # Right line
-    dist = 1
-    while ckg + dist < 8 and board[rkg][ckg + dist]['color'] == 'blank':
-        dist += 1
-    if ckg + dist < 8:
-        _piece = board[rkg][ckg + dist]
-        if _piece['color'] == enemy_col and (
-                _piece['type'] == 'queen' or
-                _piece['type'] == 'rook' or
-                (dist == 1 and _piece['type'] == 'king')
-        ):
-            return True
+    # Diags
+    for ray in BISHOP_RAYS[target]:
+        for sq in ray:
+            _piece = board[sq]
+            if _piece and sq != ignore:
+                if _piece & enemy_col and (_piece & TYPE_MASK == BISHOP or
+                                           _piece & TYPE_MASK == QUEEN):
+                    return True
+                break
 
-    # Down line
-    dist = 1
-    while rkg + dist < 8 and board[rkg + dist][ckg]['color'] == 'blank':
-        dist += 1
-    if rkg + dist < 8:
-        _piece = board[rkg + dist][ckg]
-        if _piece['color'] == enemy_col and (
-                _piece['type'] == 'queen' or
-                _piece['type'] == 'rook' or
-                (dist == 1 and _piece['type'] == 'king')
-        ):
+    # Knights, pawns and king to end with
+    enemy_knight = enemy_col | KNIGHT
+    for sq in KNIGHT_TARGETS[target]:
+        if board[sq] == enemy_knight:
             return True
-
-    # Left line
-    dist = 1
-    while ckg - dist >= 0 and board[rkg][ckg - dist]['color'] == 'blank':
-        dist += 1
-    if ckg - dist >= 0:
-        _piece = board[rkg][ckg - dist]
-        if _piece['color'] == enemy_col and (
-                _piece['type'] == 'queen' or
-                _piece['type'] == 'rook' or
-                (dist == 1 and _piece['type'] == 'king')
-        ):
+    enemy_pawn = enemy_col | PAWN
+    for sq in PAWN_ATTACKS[enemy_col ^ COLOR_MASK][target]:
+        if board[sq] == enemy_pawn:
             return True
-
-    # Checking for knights to end with
-    knight_moves = [(2, 1), (2, -1), (-2, 1), (-2, -1), (1, 2), (-1, 2),
-                    (1, -2), (-1, -2)]
-    for addr, addc in knight_moves:
-        nr, nc = rkg + addr, ckg + addc
-        if nr < 8 and nc < 8 and nr > -1 and nc > -1 and \
-            board[nr][nc]['color'] == enemy_col and \
-            board[nr][nc]['type'] == 'knight':
+    enemy_king = enemy_col | KING
+    for sq in KING_TARGETS[target]:
+        if board[sq] == enemy_king:
             return True
 
     return False
@@ -446,277 +428,506 @@ def fast_is_check2(color, board, departure, arrival, kpos=None):
     board is just before the play departure -> arrival
     We check here if moving this doesn't affect you check state. To do so, only
     the concerned row or diag shared by the king and the moved piece is
-    re-checked.
+    re-checked, departure being seen as empty (the board is not modified).
     Done to be used BEFORE using play() (to avoid using it if unauthorised) but
     you can use it after.
     """
-    enemy_col = enemy(color)
     if kpos is None:
-        rkg, ckg = king_position(color, board)
+        ksq = king_position(color, board)
     else:
-        rkg, ckg = kpos[color]
-
-    delta_row, delta_col = departure[0] - rkg, departure[1] - ckg
-
-    # Alterate board!
-    org_color = board[departure[0]][departure[1]]['color']
-    board[departure[0]][departure[1]]['color'] = 'blank'
-
-    if delta_row == 0:
-        if delta_col > 0:
-            # Right line
-            dist = 1
-            while ckg + dist < 8 and board[rkg][ckg + dist]['color'] == 'blank':
-                dist += 1
-            if ckg + dist < 8:
-                _piece = board[rkg][ckg + dist]
-                if _piece['color'] == enemy_col and (
-                        _piece['type'] == 'queen' or
-                        _piece['type'] == 'rook'
-                ):
-                    if not (arrival[0] - rkg == 0 and arrival[1] > ckg and
-                            arrival[1] - ckg <= dist):
-                        board[departure[0]][departure[1]]['color'] = org_color
-                        return True
-        else:
-            # Left line
-            dist = 1
-            while ckg - dist >= 0 and board[rkg][ckg - dist]['color'] == 'blank':
-                dist += 1
-            if ckg - dist >= 0:
-                _piece = board[rkg][ckg - dist]
-                if _piece['color'] == enemy_col and (
-                        _piece['type'] == 'queen' or
-                        _piece['type'] == 'rook'
-                ):
-                    if not (arrival[0] - rkg == 0 and arrival[1] < ckg and
-                            ckg - arrival[1] <= dist):
-                        board[departure[0]][departure[1]]['color'] = org_color
-                        return True
-
-    elif delta_col == 0:
-        if delta_row > 0:
-            # Down line
-            dist = 1
-            while rkg + dist < 8 and board[rkg + dist][ckg]['color'] == 'blank':
-                dist += 1
-            if rkg + dist < 8:
-                _piece = board[rkg + dist][ckg]
-                if _piece['color'] == enemy_col and (
-                        _piece['type'] == 'queen' or
-                        _piece['type'] == 'rook'
-                ):
-                    if not (arrival[1] - ckg == 0 and arrival[0] > rkg and
-                            arrival[0] - rkg <= dist):
-                        board[departure[0]][departure[1]]['color'] = org_color
-                        return True
-        else:
-            # Up line
-            dist = 1
-            while rkg - dist >= 0 and board[rkg - dist][ckg]['color'] == 'blank':
-                dist += 1
-            if rkg - dist >= 0:
-                _piece = board[rkg - dist][ckg]
-                if _piece['color'] == enemy_col and (
-                        _piece['type'] == 'queen' or
-                        _piece['type'] == 'rook'
-                ):
-                    if not (arrival[1] - ckg == 0 and arrival[0] < rkg and
-                            rkg - arrival[0] <= dist):
-                        board[departure[0]][departure[1]]['color'] = org_color
-                        return True
-
-    elif abs(delta_row) == abs(delta_col):
-        if delta_row > 0:
-            if delta_col > 0:
-                # Down Right diag
-                dist = 1
-                while rkg + dist < 8 and ckg + dist < 8 and \
-                    board[rkg + dist][ckg + dist]['color'] == 'blank':
-                    dist += 1
-                if rkg + dist < 8 and ckg + dist < 8:
-                    _piece = board[rkg + dist][ckg + dist]
-                    _type = _piece['type']
-                    if _piece['color'] == enemy_col and (
-                            _type == 'queen' or
-                            _type == 'bishop'
-                    ):
-                        if not (arrival[0] - rkg == arrival[1] - ckg and
-                                arrival[0] - rkg <= dist):
-                            board[departure[0]][departure[1]]['color'] = org_color
-                            return True
-            else:
-                # Down Left diag
-                dist = 1
-                while rkg + dist < 8 and ckg - dist >= 0 and \
-                    board[rkg + dist][ckg - dist]['color'] == 'blank':
-                    dist += 1
-                if rkg + dist < 8 and ckg - dist >= 0:
-                    _piece = board[rkg + dist][ckg - dist]
-                    _type = _piece['type']
-                    if _piece['color'] == enemy_col and (
-                            _type == 'queen' or
-                            _type == 'bishop'
-                    ):
-                        if not (arrival[0] - rkg == ckg - arrival[1] and
-                                arrival[0] - rkg <= dist):
-                            board[departure[0]][departure[1]]['color'] = org_color
-                            return True
-
-        else:
-            if delta_col > 0:
-                # Up Right diag
-                dist = 1
-                while rkg - dist >= 0 and ckg + dist < 8 and \
-                    board[rkg - dist][ckg + dist]['color'] == 'blank':
-                    dist += 1
-                if rkg - dist >= 0 and ckg + dist < 8:
-                    _piece = board[rkg - dist][ckg + dist]
-                    _type = _piece['type']
-                    if _piece['color'] == enemy_col and (
-                            _type == 'queen' or
-                            _type == 'bishop'
-                    ):
-                        if not (rkg - arrival[0] == arrival[1] - ckg and
-                                rkg - arrival[0] <= dist):
-                            board[departure[0]][departure[1]]['color'] = org_color
-                            return True
-            else:
-                # Up Left diag
-                dist = 1
-                while rkg - dist >= 0 and ckg - dist >= 0 and \
-                    board[rkg - dist][ckg - dist]['color'] == 'blank':
-                    dist += 1
-                if rkg - dist >= 0 and ckg - dist >= 0:
-                    _piece = board[rkg - dist][ckg - dist]
-                    _type = _piece['type']
-                    if _piece['color'] == enemy_col and (
-                            _type == 'queen' or
-                            _type == 'bishop'
-                    ):
-                        if not (rkg - arrival[0] == ckg - arrival[1] and
-                                rkg - arrival[0] <= dist):
-                            board[departure[0]][departure[1]]['color'] = org_color
-                            return True
-
-    board[departure[0]][departure[1]]['color'] = org_color
+        ksq = kpos[color]
+
+    direction = DIRECTION_TO[64 * ksq + departure]
+    if direction == -1:
+        return False
+
+    for sq in RAYS[ksq][direction]:
+        # Arrival still covers the king (or takes the attacker)
+        if sq == arrival:
+            return False
+        _piece = board[sq]
+        if _piece and sq != departure:
+            return bool(_piece & (color ^ COLOR_MASK)) and (
+                _piece & TYPE_MASK == QUEEN or
+                _piece & TYPE_MASK == DIRECTION_SLIDERS[direction])
     return False
 
-def is_enemy_check(enemy_color, board, departure, arrival,
-                   kpos):
+def attacks(board, sq, target):
     """
-    To be used after play() method
+    Whether the piece on sq attacks the target square
     """
-    rkg, ckg = kpos[enemy_color]
-    return kpos in available_movements_raw(arrival, board) or \
-        fast_is_check2(enemy_color, board, departure, arrival, kpos)
+    piece = board[sq]
+    typ = piece & TYPE_MASK
+    if typ == KNIGHT:
+        return target in KNIGHT_TARGETS[sq]
+    if typ == PAWN:
+        return target in PAWN_ATTACKS[piece & COLOR_MASK][sq]
+    if typ == KING:
+        return target in KING_TARGETS[sq]
+    direction = DIRECTION_TO[64 * sq + target]
+    if direction == -1 or (typ != QUEEN and
+                           typ != DIRECTION_SLIDERS[direction]):
+        return False
+    for between in RAYS[sq][direction]:
+        if between == target:
+            return True
+        if board[between]:
+            return False
+    return False
 
-def is_check_mate_or_draw(color, board):
+def is_enemy_check(enemy_color, board, departure, arrival,
+                   kpos):
     """
-    Tests if a situation is a checkmate or a draw
+    To be used after play() method: whether the move departure -> arrival put
+    the enemy in check (directly, by discovery or with the castling rook)
     """
-    if all_available_movements(color, board, 0, None, False, False) == []:
-        if is_check2(color, board):
-            return True, 'mate'
-        return True, 'draw'
-    return False, ''
+    ksq = kpos[enemy_color]
+    if attacks(board, arrival, ksq) or \
+        fast_is_check2(enemy_color, board, departure, arrival, kpos):
+        return True
+    # Castling: the rook stands next to the king
+    if board[arrival] & TYPE_MASK == KING and abs(arrival - departure) == 2:
+        return attacks(board, (departure + arrival) >> 1, ksq)
+    return False
 
 def get_score(color, board):
     """
     Takes a color and a board and return a score (+ in favour of the color)
     """
-    values = {
-        'pawn': 1,
-        'rook': 5,
-        'knight': 3,
-        'bishop': 3,
-        'queen': 9,
-    }
     to_return = 0
-    for row in board:
-        for piece in row:
-            to_return += (2*int(piece['color'] == color) - 1) * \
-                values.get(piece.get('type'), 0)
+    for piece in board:
+        if piece & color:
+            to_return += PIECE_VALUES[piece & TYPE_MASK]
+        elif piece:
+            to_return -= PIECE_VALUES[piece & TYPE_MASK]
     return to_return
 
 def all_available_movements(color, board, current_score, kpos, castling_left,
-                            castling_right, am_i_check=None, pos_score=True):
+                            castling_right, pos_score=True, captures_only=False,
+                            pst=None):
     """
     Takes a color, a board a current score and returns a list of dict containing
         'from': departure location
         'to': arrival location
         'score': next score after this play
-        'next': empty list to be used in evaluate_best
+    captures_only keeps captures and promotions only (quiescence search)
+    pst, if given, are piece-square tables (see
+    evaluation.piece_square_tables) whose change is added to the scores
     """
     to_return = []
     tr_app = to_return.append
-    for r, row in enumerate(board):
-        for c, piece in enumerate(row):
-            if piece['color'] == color:
-                amv = available_movements((r, c), board, castling_left,
-                                          castling_right, kpos=kpos,
-                                          am_i_check=am_i_check)
-                for nr, nc in amv:
-                    new_score = current_score + \
-                        score_per_play((nr, nc), board)*(2*int(pos_score)-1)
-                    # Bring a pawn to the edge -> +/- 8
-                    if piece['type'] == 'pawn' and (nr == 0 or nr == 7):
-                        new_score += 8 * (2*int(pos_score)-1)
-                    # Castling: fictive +0.1 bonus
-                    if color == 'white':
-                        krow = 7
-                    else:
-                        krow = 0
-                    if piece['type'] == 'king' and abs(nc - c) == 2:
-                        new_score += 0.1 * (2*int(pos_score)-1)
-                    # Lose both future castling: fictive -0.1
-                    elif castling_left and not castling_right and \
-                        (r, c) == (krow, 0):
-                        new_score -= 0.1 * (2*int(pos_score)-1)
-                    elif castling_right and not castling_left and \
-                        (r, c) == (krow, 7):
-                        new_score -= 0.1 * (2*int(pos_score)-1)
-                    elif (castling_right or castling_left) and \
-                        piece['type'] == 'king':
-                        new_score -= 0.1 * (2*int(pos_score)-1)
-                    tr_app({
-                        'from': (r, c),
-                        'to': (nr, nc),
-                        'score': new_score,
-                    })
+    # Pins and checks computed once for all pieces
+    if kpos is None:
+        kpos = {color: king_position(color, board)}
+    masks = legal_masks(color, board, kpos[color])
+    sign = 2*int(pos_score) - 1
+    rank_start = BACK_RANK_START[color]
+    if not pst is None:
+        # Tables are white's point of view
+        pst_sign = sign if color == WHITE else -sign
+        queen_table = pst[color | QUEEN]
+        rook_table = pst[color | ROOK]
+    for sq, piece in enumerate(board):
+        if piece & color:
+            typ = piece & TYPE_MASK
+            amv = available_movements(sq, board, castling_left,
+                                      castling_right, kpos=kpos, masks=masks)
+            for arrival in amv:
+                if captures_only and not board[arrival] and not (
+                        typ == PAWN and (arrival < 8 or arrival > 55)):
+                    continue
+                new_score = current_score + \
+                    PIECE_VALUES[board[arrival] & TYPE_MASK] * sign
+                # Bring a pawn to the edge -> +/- 8
+                if typ == PAWN and (arrival < 8 or arrival > 55):
+                    new_score += PROMOTION_GAIN * sign
+                    if not pst is None:
+                        new_score += pst_sign * (queen_table[arrival] -
+                                                 pst[piece][arrival])
+                # Castling: fictive +0.1 bonus
+                if typ == KING and abs(arrival - sq) == 2:
+                    new_score += 0.1 * sign
+                    if not pst is None:
+                        if arrival < sq:
+                            new_score += pst_sign * (rook_table[sq - 1] -
+                                                     rook_table[sq - 4])
+                        else:
+                            new_score += pst_sign * (rook_table[sq + 1] -
+                                                     rook_table[sq + 3])
+                # Lose both future castling: fictive -0.1
+                elif castling_left and not castling_right and \
+                    sq == rank_start:
+                    new_score -= 0.1 * sign
+                elif castling_right and not castling_left and \
+                    sq == rank_start + 7:
+                    new_score -= 0.1 * sign
+                elif (castling_right or castling_left) and typ == KING:
+                    new_score -= 0.1 * sign
+                if not pst is None:
+                    new_score += pst_sign * (pst[piece][arrival] -
+                                             pst[piece][sq] -
+                                             pst[board[arrival]][arrival])
+                tr_app({
+                    'from': sq,
+                    'to': arrival,
+                    'score': new_score,
+                })
     return to_return
 
-def build_tree(color, board, depth, castling):
+def legal_move_map(color, board, kpos, castling_left, castling_right):
+    """
+    {departure: [arrivals]} of every piece of color (empty list if it cannot
+    move)
+    """
+    masks = legal_masks(color, board, kpos[color])
+    return {
+        sq: available_movements(sq, board, castling_left, castling_right,
+                                kpos=kpos, masks=masks)
+        for sq, piece in enumerate(board) if piece & color
+    }
+
+class SearchTimeout(Exception):
+    """
+    Raised inside build_tree when the time budget is exhausted
+    """
+
+def search(color, board, depth, castling, tt=None, budget_ms=None,
+           root_moves=None, alpha=-5000, alpha_source=None, verbose=True,
+           progress=None, stop=None, stats=None, profile_dir=None,
+           pruning=None, evaluation=None):
     """
-    Constructs a tree of possible actions
+    Finds the best move of color, returns best_move, score, pv
+    best_move is the root move dict (None if there is no legal move), with
+    its minimax 'value' and the 'depth' of the last completed iteration, and
+    pv the principal variation (packed moves)
+    Only the root moves are kept in memory: see build_tree for the whole tree
+    tt is the TranspositionTable to use (and fill), a new one is created for
+    this search if None
+    If budget_ms is given, iterative deepening is used up to depth (no limit if
+    None) until the budget is spent, and the result of the last completed
+    iteration is returned
+    root_moves restricts the search to these (from, to) moves, with alpha as
+    the root lower bound. alpha_source, if given, is called during the search
+    to raise it (bound found by other searches of the same root)
+    Each searched root move gets its minimax 'value' (an upper bound if it is
+    not better than alpha)
+    progress, if given, is a dict kept up to date during the search with the
+    completed 'depth', the 'nodes' searched, the root moves done ('root_done'
+    out of 'root_total') and the 'best' (packed) move so far with its 'score'
+    stop, if given, is a threading.Event: once set, the search ends as if out
+    of time
+    stats, if given, is the SearchStats to fill (see stats.py). With a
+    profile_dir, the search runs under cProfile and dumps a pstats file there
+    pruning is the set of selective search features used (PRUNING if None)
+    evaluation is the leaf scoring, one of EVALUATIONS (EVALUATION if None)
     """
+    tree, best_index, score, pv = _search(
+        color, board, depth, castling, tt, budget_ms, root_moves, alpha,
+        alpha_source, verbose, False, progress, stop, stats, profile_dir,
+        pruning, evaluation)
+    if best_index == -1:
+        return None, score, pv
+    return tree[best_index], score, pv
+
+def build_tree(color, board, depth, castling, tt=None, budget_ms=None,
+               root_moves=None, alpha=-5000, alpha_source=None, verbose=True,
+               profile_dir=None, pruning=None, evaluation=None):
+    """
+    Debug mode of search: constructs the tree of explored moves, every move
+    getting its subtree as 'next' and the index of its best child as 'best'
+    Returns tree, best_index, stats (SearchStats). Memory grows with the
+    number of nodes searched
+    """
+    stats = SearchStats()
+    tree, best_index, _, _ = _search(
+        color, board, depth, castling, tt, budget_ms, root_moves, alpha,
+        alpha_source, verbose, True, None, None, stats, profile_dir, pruning,
+        evaluation)
+    return tree, best_index, stats
+
+def _search(color, board, depth, castling, tt, budget_ms, root_moves, alpha,
+            alpha_source, verbose, keep_tree, progress, stop, stats=None,
+            profile_dir=None, pruning=None, evaluation=None):
+    """
+    Iterative deepening loop shared by search and build_tree
+    Returns tree, best_index, score, pv
+    """
+    if stats is None:
+        stats = SearchStats()
+    if not profile_dir is None:
+        return profiled(profile_dir, stats, _search, color, board, depth,
+                        castling, tt, budget_ms, root_moves, alpha,
+                        alpha_source, verbose, keep_tree, progress, stop,
+                        stats, None, pruning, evaluation)
+    if pruning is None:
+        pruning = PRUNING
+    null_move = 'null_move' in pruning
+    lmr = 'lmr' in pruning
+    futility = 'futility' in pruning
+    if evaluation is None:
+        evaluation = EVALUATION
+    if not evaluation in EVALUATIONS:
+        raise ValueError('unknown evaluation: {}'.format(evaluation))
+    batch_evaluation = evaluation == 'batch'
+    if depth is None:
+        depth = MAX_DEPTH
     current_score = get_score(color, board)
-    killers = [None for _ in range(depth + 1)]
+    pst = None
+    phase_key = 0
+    if evaluation != 'material':
+        pst = piece_square_tables(board)
+        # Scores of positions reached from roots of another phase are not
+        # comparable: their table entries get other keys
+        phase_key = PHASE_KEYS[game_phase(board)]
+        current_score += (1 if color == WHITE else -1) * score_leaf(
+            board, material=False, mobility=False)
+    # Two killer moves by ply (distance to the root), reused between
+    # iterations
+    killers = [[NO_MOVE, NO_MOVE] for _ in range(depth + 1)]
+    # Indexed by previous move: reply that refuted it last
+    counter_moves = [NO_MOVE] * 4096
+    # Indexed by piece << 6 | arrival: cutoffs made by quiet moves
+    history = [0] * (32 << 6)
     nodes_seen = [0]
+    # Counters of the search, as local names
+    node_counts = stats.nodes
+    if len(node_counts) <= depth:
+        node_counts += [0] * (depth + 1 - len(node_counts))
+    tt_stats = stats.tt
+    killer_stats = stats.killers
+    # movegen, ordering, check detection, leaf evaluation
+    timers = stats.timers
+    # qnodes, expanded, children, cutoffs, first move cutoffs, null moves
+    # searched, null move cutoffs, reduced moves, reduced moves searched
+    # again, futile moves, null window searches, null window searches
+    # searched again, aspiration fail lows, aspiration fail highs
+    counters = [0] * 14
+    if tt is None:
+        tt = TranspositionTable()
+    tt.new_search()
+    # Scores are stored in the table from white's point of view
+    tt_sign = 1 if color == WHITE else -1
+    zkey = [0]
+    # Depth of the running iteration, and of the line to be tried first
+    root_depth = [depth]
+    pv_line = []
+    # Triangular PV table: pv_table[ply][ply:pv_length[ply]] is the best line
+    # found from the node being searched at ply
+    pv_table = [[NO_MOVE] * (depth + 1) for _ in range(depth + 1)]
+    pv_length = [0] * (depth + 2)
+    # No deadline until a first iteration is completed
+    deadline = [None]
+    if progress is None:
+        progress = {}
+    progress.update(depth=0, nodes=0, root_done=0, root_total=0, best=NO_MOVE,
+                    score=0)
+
+    def checkpoint():
+        """
+        Called every 256 nodes: raises SearchTimeout once out of time (or
+        stopped)
+        """
+        progress['nodes'] = nodes_seen[0]
+        if (not deadline[0] is None and time() > deadline[0]) or (
+                not stop is None and stop.is_set()):
+            raise SearchTimeout()
+
+    def quiescence(current_board, current_score, current_kpos, current_color,
+                   current_checked, alpha, beta, qply=0):
+        """
+        Returns the score of a position once captures and promotions are
+        played out (all moves if in check in the first EVASION_PLIES)
+        """
+        nodes_seen[0] += 1
+        counters[0] += 1
+        if nodes_seen[0] & 255 == 0:
+            checkpoint()
+        # Positive if current color is hero's one
+        sign = 2 * int(current_color == color) - 1
+        evasions = current_checked and qply < EVASION_PLIES
+        if evasions:
+            # No stand pat: every evasion is searched
+            nu = -5000 * sign
+            stand_pat = None
+        else:
+            # Stand pat: the side to move can decline all captures
+            nu = stand_pat = current_score
+            if (sign == 1 and nu >= beta) or (sign == -1 and nu <= alpha):
+                return nu
+            if sign == 1 and nu > alpha:
+                alpha = nu
+            if sign == -1 and nu < beta:
+                beta = nu
+            # Delta pruning: even a queen won't bring the score in the window.
+            # The bound returned is the window's: the skipped captures could
+            # be worth up to it (stand pat would be too tight a bound)
+            best_gain = PIECE_VALUES[QUEEN] + DELTA_MARGIN
+            if (current_color | PAWN) in \
+                    current_board[SEVENTH_RANK[current_color]]:
+                best_gain += PROMOTION_GAIN
+            if sign == 1 and nu + best_gain <= alpha:
+                return alpha
+            if sign == -1 and nu - best_gain >= beta:
+                return beta
+
+        t_start = perf_counter()
+        moves = all_available_movements(current_color, current_board,
+                                        current_score, current_kpos,
+                                        False, False,
+                                        pos_score=current_color == color,
+                                        captures_only=not evasions, pst=pst)
+        t_moves = perf_counter()
+        timers[0] += t_moves - t_start
+        if len(moves) == 0:
+            if evasions:
+                return -sign*1000
+            return nu
+        order_moves(moves, current_board)
+        timers[1] += perf_counter() - t_moves
+
+        for move in moves:
+            # Delta pruning: skip captures that can't bring the score near the
+            # window
+            if not stand_pat is None:
+                gain = abs(move['score'] - stand_pat) + DELTA_MARGIN
+                # The score is then bounded by what the capture could bring
+                if sign == 1 and stand_pat + gain <= alpha:
+                    if stand_pat + gain > nu:
+                        nu = stand_pat + gain
+                    continue
+                if sign == -1 and stand_pat - gain >= beta:
+                    if stand_pat - gain < nu:
+                        nu = stand_pat - gain
+                    continue
+            start, arrival = move['from'], move['to']
+            former_start = current_board[start]
+            former_arrival = current_board[arrival]
+            play(start, arrival, current_board, current_kpos)
+            t_start = perf_counter()
+            checked = is_enemy_check(enemy(current_color), current_board,
+                                     start, arrival, current_kpos)
+            timers[2] += perf_counter() - t_start
+            next_nu = quiescence(
+                current_board,
+                move['score'],
+                current_kpos,
+                enemy(current_color),
+                checked,
+                alpha,
+                beta,
+                qply + 1,
+            )
+            unplay(start, former_start, arrival, former_arrival,
+                   current_board, current_kpos)
+            if sign == 1 and next_nu > nu:
+                nu = next_nu
+                if nu > alpha:
+                    alpha = nu
+            if sign == -1 and next_nu < nu:
+                nu = next_nu
+                if nu < beta:
+                    beta = nu
+            if alpha >= beta:
+                break
+        return nu
 
     def internal_evaluate(current_board, current_cast, current_depth,
                           current_score, current_kpos, current_color,
-                          current_checked, alpha, beta):
+                          current_checked, alpha, beta, on_pv=False,
+                          previous_move=NO_MOVE, ply=0, null_allowed=True):
         """
         Returns subtree, current_lambda, best_index
+        ply is the distance to the root (depths are reduced by some pruning)
         """
         nodes_seen[0] += 1
-        if current_depth == 0:
-            return [], current_score, -1
+        if nodes_seen[0] & 255 == 0:
+            checkpoint()
+        node_counts[ply] += 1
+        pv_length[ply] = ply
+        if current_depth <= 0:
+            return [], quiescence(current_board, current_score, current_kpos,
+                                  current_color, current_checked, alpha,
+                                  beta), -1
+
+        # Transposition table lookup (never at the root: we need the tree)
+        tt_stats[0] += 1
+        entry = tt.probe(zkey[0])
+        hash_move = NO_MOVE
+        if not entry is None:
+            tt_stats[1] += 1
+            tt_depth, tt_flag, tt_score, hash_move = entry
+            tt_score *= tt_sign
+            if ply > 0 and tt_depth >= current_depth and (
+                    tt_flag == EXACT or
+                    (tt_flag == LOWER and tt_score >= beta) or
+                    (tt_flag == UPPER and tt_score <= alpha)
+            ):
+                tt_stats[2] += 1
+                return [], tt_score, -1
+        # Previous iteration's best line first
+        if on_pv and ply < len(pv_line):
+            hash_move = pv_line[ply]
+        else:
+            on_pv = False
 
+        # Positive if current color is hero's one
+        sign = 2 * int(current_color == color) - 1
+
+        # Null move: if passing is still good enough for the side to move,
+        # a real move will be too. Not when in check (illegal), nor without
+        # pieces (zugzwang, where passing would be the best move)
+        if null_move and null_allowed and not on_pv and ply > 0 and \
+                not current_checked and current_depth > NULL_REDUCTION and (
+                    (sign == 1 and current_score >= beta) or
+                    (sign == -1 and current_score <= alpha)) and \
+                any(piece & current_color and
+                    KNIGHT <= piece & TYPE_MASK <= QUEEN
+                    for piece in current_board):
+            counters[5] += 1
+            zkey[0] ^= ZOBRIST_SIDE
+            if sign == 1:
+                null_alpha, null_beta = beta - NULL_WINDOW, beta
+            else:
+                null_alpha, null_beta = alpha, alpha + NULL_WINDOW
+            null_score = current_score
+            # Straight to a leaf: not evaluated by a batch
+            if batch_evaluation and current_depth - 1 - NULL_REDUCTION <= 0:
+                t_start = perf_counter()
+                null_score += tt_sign * score_leaf(
+                    current_board, material=False, piece_square=False)
+                timers[3] += perf_counter() - t_start
+            try:
+                _, null_nu, _ = internal_evaluate(
+                    current_board, current_cast,
+                    current_depth - 1 - NULL_REDUCTION, null_score,
+                    current_kpos, enemy(current_color), False, null_alpha,
+                    null_beta, ply=ply + 1, null_allowed=False)
+            finally:
+                zkey[0] ^= ZOBRIST_SIDE
+            # The bound only: a mate found after a pass is no proof
+            if sign == 1 and null_nu >= beta:
+                counters[6] += 1
+                return [], beta, -1
+            if sign == -1 and null_nu <= alpha:
+                counters[6] += 1
+                return [], alpha, -1
+
+        t_start = perf_counter()
         moves = all_available_movements(current_color, current_board,
                                         current_score, current_kpos,
                                         current_cast[current_color]['left'],
                                         current_cast[current_color]['right'],
                                         pos_score=current_color == color,
-                                        am_i_check=None)
+                                        pst=pst)
+        timers[0] += perf_counter() - t_start
 
-        # Positive if current color is hero's one
-        sign = 2 * int(current_color == color) - 1
+        if ply == 0 and not root_moves is None:
+            moves = [move for move in moves
+                     if (move['from'], move['to']) in root_moves]
 
         # Treat checkmate and draw cases
         if len(moves) == 0:
-            if is_check2(current_color, current_board, current_kpos):
+            if current_checked:
                 return [], -sign*1000, -1
             return [], 0, -1
 
@@ -729,210 +940,416 @@ def build_tree(color, board, depth, castling):
 
         best_index = -1
 
-        sort_by_interest(
-            moves,
-            current_color,
-            current_color == color,
-            current_board,
-            current_kpos,
-            randomize=depth - current_depth < 2,
-            danger_first=depth - current_depth < 4,
-            checkers_first=depth - current_depth < 4,
-            killer_move=killers[current_depth],
-        )
+        # Some variety between games
+        t_start = perf_counter()
+        if ply < 2:
+            shuffle(moves)
+        ply_killers = killers[ply]
+        order_moves(moves, current_board, hash_move, ply_killers,
+                    counter_moves[previous_move], history)
+        timers[1] += perf_counter() - t_start
+        counters[1] += 1
+
+        # The children are leaves: mobility scores of all of them in one
+        # go. Quiescence then only adds material and piece-square changes
+        if batch_evaluation and current_depth == 1:
+            t_start = perf_counter()
+            leaves = []
+            for move in moves:
+                start, arrival = move['from'], move['to']
+                former_start = current_board[start]
+                former_arrival = current_board[arrival]
+                play(start, arrival, current_board)
+                leaves.append(bytes(current_board))
+                unplay(start, former_start, arrival, former_arrival,
+                       current_board)
+            for move, score in zip(moves, score_batch(
+                    leaves, material=False, piece_square=False)):
+                move['score'] += tt_sign * score
+            timers[3] += perf_counter() - t_start
+
+        if ply == 0:
+            progress['root_total'] = len(moves)
 
         for n, move in enumerate(moves):
 
-            if current_depth == depth:
+            if ply == 0:
+                progress['root_done'] = n
+            if ply == 0 and verbose:
                 print('{}/{} {} {} -> {}'.format(
                     str(n+1).zfill(2),
                     len(moves),
-                    current_board[move['from'][0]]
-                    [move['from'][1]]['type'].ljust(6),
-                    move['from'],
-                    move['to'],
+                    TYPE_NAMES[current_board[move['from']] & TYPE_MASK]
+                    .ljust(6),
+                    readable_position(move['from']),
+                    readable_position(move['to']),
                 ))
                 print('{}%'.format(int(100*n/len(moves))), end='\r')
 
-            unplay_infos = play(move['from'], move['to'], current_board,
-                                current_kpos)
+            start, arrival = move['from'], move['to']
+            packed = pack_move(start, arrival)
+            # Kept to undo the move (no tuple from play())
+            former_start = current_board[start]
+            former_arrival = current_board[arrival]
+            # Neither a capture nor a promotion
+            quiet = not former_arrival and not (
+                former_start & TYPE_MASK == PAWN and
+                (arrival < 8 or arrival > 55))
+            play(start, arrival, current_board, current_kpos, zkey)
 
             # Update castling infos if needed:
-            old_cl = current_cast[current_color]['left']
-            old_cr = current_cast[current_color]['right']
-            new_cl, new_cr = update_castling(move['from'], current_color,
-                                             old_cl, old_cr)
-            current_cast[current_color] = {
-                'left': new_cl,
-                'right': new_cr,
-            }
-
-
-            next_list, next_nu, _ = internal_evaluate(
+            old_cast, cast_key = play_castling(current_cast, current_color,
+                                               start, arrival)
+            zkey[0] ^= cast_key
+
+            is_killer = packed == ply_killers[0] or packed == ply_killers[1]
+            if is_killer:
+                killer_stats[0] += 1
+
+            t_start = perf_counter()
+            checked = is_enemy_check(enemy(current_color), current_board,
+                                     start, arrival, current_kpos)
+            timers[2] += perf_counter() - t_start
+
+            reduction = 0
+            if quiet and ply > 0 and not current_checked and not checked:
+                # Futility: the opponent can stand pat after a quiet move, so
+                # its score hardly moves from the one it leads to
+                if futility and current_depth == 1 and (
+                        (sign == 1 and
+                         move['score'] + FUTILITY_MARGIN <= new_alpha) or
+                        (sign == -1 and
+                         move['score'] - FUTILITY_MARGIN >= new_beta)):
+                    counters[9] += 1
+                    bound = move['score'] + sign * FUTILITY_MARGIN
+                    if (sign == 1 and bound > nu) or \
+                            (sign == -1 and bound < nu):
+                        nu = bound
+                    zkey[0] ^= cast_key
+                    unplay(start, former_start, arrival, former_arrival,
+                           current_board, current_kpos, zkey)
+                    unplay_castling(current_cast, current_color, old_cast)
+                    continue
+                if lmr and n >= LMR_MOVES and \
+                        current_depth >= LMR_MIN_DEPTH and \
+                        packed != hash_move and not is_killer:
+                    reduction = 1
+                    counters[7] += 1
+
+            # Principal variation search: once a move was searched, the
+            # others only have to be proven worse, with a null window
+            full_window = best_index == -1
+            if full_window:
+                child_alpha, child_beta = new_alpha, new_beta
+            elif sign == 1:
+                counters[10] += 1
+                child_alpha, child_beta = new_alpha, new_alpha + NULL_WINDOW
+            else:
+                counters[10] += 1
+                child_alpha, child_beta = new_beta - NULL_WINDOW, new_beta
+            next_list, next_nu, next_best = internal_evaluate(
                 current_board,
                 current_cast,
-                current_depth - 1,
+                current_depth - 1 - reduction,
                 move['score'],
                 current_kpos,
                 enemy(current_color),
-                is_enemy_check(
-                    enemy(color),
-                    current_board,
-                    move['from'],
-                    move['to'],
-                    current_kpos
-                ),
-                new_alpha,
-                new_beta,
+                checked,
+                child_alpha,
+                child_beta,
+                on_pv and packed == hash_move,
+                packed,
+                ply + 1,
             )
-
-            move['next'] = next_list
+            # A reduced move that looks better than the best one so far is
+            # searched again at full depth
+            if reduction and ((sign == 1 and next_nu > new_alpha) or
+                              (sign == -1 and next_nu < new_beta)):
+                counters[8] += 1
+                next_list, next_nu, next_best = internal_evaluate(
+                    current_board, current_cast, current_depth - 1,
+                    move['score'], current_kpos, enemy(current_color),
+                    checked, child_alpha, child_beta, False, packed, ply + 1)
+            # Not proven worse, nor good enough to cut: exact value needed
+            if not full_window and new_alpha < next_nu < new_beta:
+                counters[11] += 1
+                next_list, next_nu, next_best = internal_evaluate(
+                    current_board, current_cast, current_depth - 1,
+                    move['score'], current_kpos, enemy(current_color),
+                    checked, new_alpha, new_beta, False, packed, ply + 1)
+
+            if keep_tree:
+                move['next'] = next_list
+                move['best'] = next_best
+            if ply == 0:
+                move['value'] = next_nu
 
             # Hero play (maximiser)
-            if sign == 1 and next_nu > nu:
-                nu = next_nu
-                best_index = n
-            if sign == -1 and next_nu < nu:
+            if (sign == 1 and next_nu > nu) or (sign == -1 and next_nu < nu):
                 nu = next_nu
                 best_index = n
+                # Best line: this move then the child's one
+                line, child_line = pv_table[ply], pv_table[ply + 1]
+                end = pv_length[ply + 1]
+                line[ply] = packed
+                line[ply + 1:end] = child_line[ply + 1:end]
+                pv_length[ply] = end
+                if ply == 0:
+                    progress['best'] = packed
+                    progress['score'] = nu
 
             # update alpha, beta (avoiding using min/max)
             if sign == 1 and nu > new_alpha:
                 new_alpha = next_nu
             if sign == -1 and nu < new_beta:
                 new_beta = next_nu
+            # Bound shared with other searches of the root
+            if ply == 1 and not alpha_source is None:
+                shared_alpha = alpha_source()
+                if shared_alpha > new_alpha:
+                    alpha = new_alpha = shared_alpha
 
-            unplay(*unplay_infos, board=current_board, kpos=current_kpos)
+            zkey[0] ^= cast_key
+            unplay(start, former_start, arrival, former_arrival,
+                   current_board, current_kpos, zkey)
 
-            current_cast[current_color] = {
-                'left': old_cl,
-                'right': old_cr,
-            }
+            unplay_castling(current_cast, current_color, old_cast)
 
             if new_alpha >= new_beta or new_alpha > 900 or new_beta < -900:
-                killers[current_depth] = move
+                counters[3] += 1
+                if n == 0:
+                    counters[4] += 1
+                if is_killer:
+                    killer_stats[1] += 1
+                # Quiet move refutation: remembered for move ordering
+                piece = current_board[move['from']]
+                if not current_board[move['to']] and not (
+                        piece & TYPE_MASK == PAWN and
+                        (move['to'] < 8 or move['to'] > 55)):
+                    if ply_killers[0] != packed:
+                        ply_killers[1] = ply_killers[0]
+                        ply_killers[0] = packed
+                    counter_moves[previous_move] = packed
+                    index = piece << 6 | move['to']
+                    history[index] += current_depth * current_depth
+                    if history[index] > HISTORY_MAX:
+                        for i in range(len(history)):
+                            history[i] >>= 1
                 break
+        counters[2] += n + 1
+
+        # A search stopped early by a mate score only bounds the result
+        complete = n == len(moves) - 1 and new_alpha < new_beta
+        if nu >= beta or (sign == 1 and not complete):
+            tt_flag = LOWER
+        elif nu <= alpha or (sign == -1 and not complete):
+            tt_flag = UPPER
+        else:
+            tt_flag = EXACT
+        best_packed = NO_MOVE
+        # All moves futile: no best one
+        if best_index != -1:
+            best_move = moves[best_index]
+            best_packed = pack_move(best_move['from'], best_move['to'])
+        # A root restricted to some moves is not a real position evaluation
+        if ply > 0 or root_moves is None:
+            tt.store(zkey[0], current_depth, tt_flag, nu * tt_sign,
+                     best_packed)
 
         return moves, nu, best_index
 
-    kpos = {
-        'white': king_position('white', board),
-        'black': king_position('black', board),
-    }
+    if budget_ms is None:
+        iterations = [depth]
+    else:
+        iterations = range(1, depth + 1)
+    tr, best_index, score, searched_depth = [], -1, 0, 0
     t1 = time()
-    tr, _, best_index = internal_evaluate(deepcopy(board), castling, depth,
-                                          current_score, kpos, color,
-                                          is_check2(color, board, kpos), -5000,
-                                          5000)
+    for iteration_depth in iterations:
+        # Fresh copies: an aborted iteration leaves them in an unknown state
+        search_board = bytearray(board)
+        search_cast = {col: dict(rights) for col, rights in castling.items()}
+        kpos = {
+            WHITE: king_position(WHITE, board),
+            BLACK: king_position(BLACK, board),
+        }
+        zkey[0] = position_hash(board, color, castling) ^ phase_key
+        root_depth[0] = iteration_depth
+        t_iteration = time()
+        iteration_nodes = nodes_seen[0]
+        # Aspiration window around the previous score (not for a root
+        # restricted to some moves: their values are compared between
+        # searches)
+        low, high = alpha, 5000
+        window = ASPIRATION_WINDOW
+        if searched_depth and root_moves is None:
+            low, high = max(alpha, score - window), score + window
+        root_checked = is_check2(color, board, kpos)
+        try:
+            while True:
+                result = internal_evaluate(
+                    search_board, search_cast, iteration_depth,
+                    current_score, kpos, color, root_checked, low, high,
+                    on_pv=True)
+                window *= 2
+                if result[1] <= low and low > alpha:
+                    counters[12] += 1
+                    low = alpha if window > ASPIRATION_MAX else \
+                        max(alpha, result[1] - window)
+                elif result[1] >= high and high < 5000:
+                    counters[13] += 1
+                    high = 5000 if window > ASPIRATION_MAX else \
+                        result[1] + window
+                else:
+                    break
+        except SearchTimeout:
+            if verbose:
+                print('Depth {}: out of time'.format(iteration_depth))
+            break
+        tr, score, best_index = result
+        searched_depth = iteration_depth
+        pv_line = pv_table[0][:pv_length[0]]
+        stats.iterations.append({
+            'depth': iteration_depth,
+            'nodes': nodes_seen[0] - iteration_nodes,
+            'time': round(time() - t_iteration, 3),
+            'score': score,
+        })
+        progress.update(depth=iteration_depth, nodes=nodes_seen[0],
+                        root_done=len(tr), score=score)
+        if budget_ms is None or best_index == -1 or abs(score) > 900:
+            break
+        if verbose:
+            print('Depth {}: {} ({}) in {:.2f} s'.format(
+                iteration_depth, readable_line(pv_line), score,
+                time() - t_iteration))
+        # Next iteration is at least as long as this one: don't start it if
+        # there is no time left for it
+        deadline[0] = t1 + budget_ms / 1000
+        if time() + (time() - t_iteration) > deadline[0]:
+            break
     t2 = time()
-    print('Time Elapsed: %.2f s' % (t2-t1))
-    print('Nodes Explored: {}, {} n/s'.format(nodes_seen[0],
-                                              int(nodes_seen[0] / (t2 - t1))))
-    return tr, best_index
+    stats.time += t2 - t1
+    stats.qnodes += counters[0]
+    stats.expanded += counters[1]
+    stats.children += counters[2]
+    stats.cutoffs += counters[3]
+    stats.first_move_cutoffs += counters[4]
+    for n, count in enumerate(counters[5:10]):
+        stats.pruning[n] += count
+    for n, count in enumerate(counters[10:]):
+        stats.researches[n] += count
+    if verbose:
+        print('Time Elapsed: %.2f s' % (t2-t1))
+        print('Nodes Explored: {}, {} n/s'.format(
+            nodes_seen[0], int(nodes_seen[0] / (t2 - t1))))
+        print("TT: {} probes, {} hits, {} cutoffs, {}/1000 full".format(
+            tt_stats[0], tt_stats[1], tt_stats[2], tt.usage()))
+        print(stats.summary())
+    if best_index != -1:
+        tr[best_index]['depth'] = searched_depth
+        progress.update(best=pack_move(tr[best_index]['from'],
+                                       tr[best_index]['to']), score=score)
+    return tr, best_index, score, pv_line
+
+def readable_line(line):
+    """
+    Packed moves -> "e2-e4 e7-e5 ..."
+    """
+    return ' '.join('{}-{}'.format(readable_position(start),
+                                   readable_position(arrival))
+                    for start, arrival in map(unpack_move, line))
 
 def readable_position(pos):
     """
-    Converts tuple to readable chess position:
-    example: (6, 3) -> "d2"
-    """
-    return ['a', 'b', 'c', 'd', 'e', 'f', 'g', 'h'][pos[1]] + str(8 - pos[0])
-
-def sort_by_interest(tree, color, maximize, board, kpos, randomize=False,
-                     danger_first=False, checkers_first=False,
-                     killer_move=None):
-    """
-    Unefficient function to sort nodes from a tree in order of potential
-    interest (check positions first, then enemy pieces killing)
-    """
-    # Randomize first
-    if randomize:
-        shuffle(tree)
-    _sorted = 0
-    # Killer move first
-    if not killer_move is None:
-        for n, elt in enumerate(tree):
-            if elt['from'] == killer_move['from'] and \
-                elt['to'] == killer_move['to']:
-                tree[0], tree[n] = tree[n], tree[0]
-                _sorted += 1
-                break
-    # Checkers first
-    if checkers_first:
-        for n in range(_sorted + 1, len(tree)):
-            unplay_data = play(tree[n]['from'], tree[n]['to'], board, kpos)
-            if is_check2(enemy(color), board, kpos):
-                tree[_sorted], tree[n] = tree[n], tree[_sorted]
-                _sorted += 1
-            unplay(*unplay_data, board=board, kpos=kpos)
-    # Basic sorting method by direct score (kills first !)
-    for i in range(_sorted + 1, len(tree)):
-        _idx = i
-        _max_or_min = tree[i]['score']
-        for j in range(i + 1, len(tree)):
-            if maximize and tree[j]['score'] > _max_or_min:
-                _max_or_min = tree[j]['score']
-                _idx = j
-            if (not maximize) and tree[j]['score'] > _max_or_min:
-                _max_or_min = tree[j]['score']
-                _idx = j
-        tree[i], tree[_idx] = tree[_idx], tree[i]
-    if danger_first:
-        # Avoid kill first (amongst null scores)
-        # index is to be at the beginning of null score
-        index = len(tree) - 1
-        while index >= 0 and tree[index]['score'] == tree[-1]['score']:
-            index -= 1
-        # List all in danger pieces
-        enemy_moves = all_available_movements(enemy(color), board, 0, kpos,
-                                              False, False, pos_score=True)
-        in_danger = []
-        for elt in enemy_moves:
-            if elt['score'] > 0:
-                in_danger.append(elt['to'])
-        # Put endangered pieces moves first (after other sorted pieces)
-        for idx2 in range(index, len(tree)):
-            if tree[idx2]['from'] in in_danger:
-                tree[index], tree[idx2] = tree[idx2], tree[index]
-                index += 1
+    Converts square index to readable chess position:
+    example: 51 -> "d2"
+    """
+    return 'abcdefgh'[pos & 7] + str(8 - (pos >> 3))
+
+def parse_position(text):
+    """
+    Inverse of readable_position: "d2" -> 51
+    """
+    return 8 * (8 - int(text[1])) + 'abcdefgh'.index(text[0])
+
+def parse_line(text):
+    """
+    Inverse of readable_line: "e2-e4 e7-e5 ..." -> packed moves
+    """
+    return [pack_move(parse_position(move[:2]), parse_position(move[-2:]))
+            for move in text.split()]
+
+def order_moves(moves, board, hash_move=NO_MOVE, killers=(),
+                counter_move=NO_MOVE, history=None):
+    """
+    Sorts moves in place in order of potential interest, in a single pass on
+    precomputed keys: hash move, captures and promotions (most valuable victim
+    first, then least valuable attacker), killers, counter move, then quiet
+    moves by history. Equal keys keep their order
+    """
+    def key(move):
+        start, arrival = move['from'], move['to']
+        packed = start << 6 | arrival
+        if packed == hash_move:
+            return ORDER_HASH
+        piece = board[start]
+        gain = PIECE_VALUES[board[arrival] & TYPE_MASK]
+        if piece & TYPE_MASK == PAWN and (arrival < 8 or arrival > 55):
+            gain += PROMOTION_GAIN
+        if gain:
+            return ORDER_CAPTURE + 16 * gain - PIECE_VALUES[piece & TYPE_MASK]
+        if packed in killers:
+            return ORDER_KILLER - killers.index(packed)
+        if packed == counter_move:
+            return ORDER_COUNTER
+        if history is None:
+            return 0
+        return history[piece << 6 | arrival]
+    moves.sort(key=key, reverse=True)
 
 def update_castling(start, color, castling_left, castling_right):
     new_cl, new_cr = castling_left, castling_right
-    row = {'white': 7, 'black': 0}[color]
-    if castling_left and start[0] == row and (start[1] == 4 or start[1] == 0):
+    rank_start = BACK_RANK_START[color]
+    if castling_left and (start == rank_start + 4 or start == rank_start):
         new_cl = False
-    if castling_right and start[0] == row and (start[1] == 4 or start[1] == 7):
+    if castling_right and (start == rank_start + 4 or start == rank_start + 7):
         new_cr = False
     return new_cl, new_cr
 
-def missing_pieces(board):
+def play_castling(castling, color, start, arrival):
     """
-    Finds who is missing in the board to show taken pieces
+    Updates castling rights of both colors after a move start -> arrival of
+    color (moved king or rook, taken rook). MODIFIES castling, rights dicts
+    are replaced (by shared CASTLING_RIGHTS ones), not modified.
+    Returns the former rights, to be given to unplay_castling, and the zobrist
+    delta of the change. Moves changing nothing allocate nothing: they get
+    NO_CASTLING_CHANGE
     """
-    missing = {
-        'black': {
-            'king': 1,
-            'queen': 1,
-            'bishop': 2,
-            'knight': 2,
-            'rook': 2,
-            'pawn': 8,
-        },
-    }
-    missing['white'] = deepcopy(missing['black'])
-    for row in board:
-        for elt in row:
-            if elt['color'] != 'blank':
-                missing[elt['color']][elt['type']] -= 1
-    to_return = {
-        "black": [],
-        "white": [],
-    }
-    for _color in to_return:
-        for _type in ['queen', 'rook', 'bishop', 'knight', 'pawn']:
-            for _ in range(missing[_color][_type]):
-                to_return[_color].append(_type)
-    to_return['black'].reverse()
-    return to_return
+    if not start in CASTLING_SQUARES and not arrival in CASTLING_SQUARES:
+        return NO_CASTLING_CHANGE
+    enemy_col = color ^ COLOR_MASK
+    own, other = castling[color], castling[enemy_col]
+    delta = 0
+    for col, sq, rights in ((color, start, own), (enemy_col, arrival, other)):
+        if rights['left'] or rights['right']:
+            new_cl, new_cr = update_castling(sq, col, rights['left'],
+                                             rights['right'])
+            if new_cl != rights['left'] or new_cr != rights['right']:
+                if new_cl != rights['left']:
+                    delta ^= ZOBRIST_CASTLING[col][0]
+                if new_cr != rights['right']:
+                    delta ^= ZOBRIST_CASTLING[col][1]
+                castling[col] = CASTLING_RIGHTS[new_cl, new_cr]
+    if not delta:
+        return NO_CASTLING_CHANGE
+    return (own, other), delta
+
+def unplay_castling(castling, color, former):
+    """
+    Undo the effect of play_castling(). MODIFIES castling
+    """
+    if not former is None:
+        castling[color], castling[color ^ COLOR_MASK] = former
 
 def print_board(board):
     """
@@ -940,25 +1357,25 @@ def print_board(board):
     """
     def _print_piece(piece):
         initials = {
-            'pawn': 'p',
-            'rook': 'r',
-            'knight': 'k',
-            'bishop': 'b',
-            'queen': 'q',
-            'king': 'g',
+            PAWN: 'p',
+            ROOK: 'r',
+            KNIGHT: 'k',
+            BISHOP: 'b',
+            QUEEN: 'q',
+            KING: 'g',
         }
-        if piece['color'] == 'blank':
+        if piece == EMPTY:
             print('   ', end=' ')
-        elif piece['color'] == 'black':
-            print(' B' + initials[piece['type']], end=' ')
+        elif piece & BLACK:
+            print(' B' + initials[piece & TYPE_MASK], end=' ')
         else:
-            print(' W' + initials[piece['type']], end=' ')
+            print(' W' + initials[piece & TYPE_MASK], end=' ')
 
     line = '\n' + '-' * (8 * 4 + 9)
-    for row in board:
+    for r in range(8):
         print(line)
         print('|', end='')
-        for piece in row:
+        for piece in board[8 * r:8 * r + 8]:
             _print_piece(piece)
             print('|', end='')
     print(line)